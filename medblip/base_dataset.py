@@ -1,16 +1,27 @@
 import io
+import multiprocessing
 import os
 import random
+import time
+from functools import cached_property
 
+import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
 import torch
 from PIL import Image
 
-from .utils import record_ent_ref, create_pos_matrix
+from .utils import record_ent_ref, create_pos_matrices, labels_to_csr, csr_to_dense, csr_to_packed
 from .transforms import keys_to_transforms
 from torch.utils.data import DataLoader
 from transformers import DataCollatorForLanguageModeling, BertTokenizerFast, RobertaTokenizerFast
 from .data_collator import DataCollatorForWholeEntityMask
+from .image_store import load_image_store
+from .index_cache import index_cache_key, index_cache_path, load_index_cache, save_index_cache
+from .lazy_table import ChunkIndex, IndexMapper, LazyColumn
+from .pretokenize import PretokenizedText
+from .quarantine import load_quarantine, quarantine_path
 
 FG_TEXT_LIST = ['normal', 'pleural effusion', 'opacity', 'pneumothorax', 'edema', 'atelectasis',  'tube', 'consolidation','enlarged cardiomediastinum','tip', 'pneumonia','line','cardiomegaly', 'fracture','calcification',
                 'device','engorgement',  'nodule', 'wire',  'pacemaker', 'pleural thicken', 'marking', 'scar', 'hyperinflate', 'blunt',  'collapse', 'emphysema', 'aerate', 'mass','infiltration', 'obscure', 'deformity', 'hernia',
@@ -33,6 +44,48 @@ def get_pretrained_tokenizer(from_pretrained):
     return tokenizer
 
 
+def read_fg_radgraph_csv(path):
+    '''image basenames and the boolean (rows, len(FG_TEXT_LIST)) label matrix of fg_radgraph_metric.csv'''
+    csv = pa.csv.read_csv(path)
+    basenames = pc.replace_substring_regex(csv.column(0).cast(pa.string()), pattern=r"^.*/", replacement="")
+    labels = np.zeros((csv.num_rows, len(FG_TEXT_LIST)), dtype=bool)
+    for idx in range(min(csv.num_columns - 1, len(FG_TEXT_LIST))):
+        values = csv.column(idx + 1).cast(pa.float64()).fill_null(0)
+        labels[:, idx] = values.to_numpy() >= 1
+    return basenames.combine_chunks(), labels
+
+
+def load_fg_radgraph_labels(data_dir, name, image_ids):
+    '''bit-packed (N, ceil(len(FG_TEXT_LIST) / 8)) radgraph labels aligned to the rows of {name}.arrow.
+    the matrix is cached next to the arrow file when data_dir is writable, and rebuilt when the csv or the
+    arrow file is newer.
+    '''
+    csv_path = f"{data_dir}/fg_radgraph_metric.csv"
+    arrow_path = f"{data_dir}/pretrain_arrows_umls/{name}.arrow"
+    cache_path = f"{data_dir}/pretrain_arrows_umls/{name}_fg_radgraph.npy"
+    if os.path.isfile(cache_path) and \
+            os.path.getmtime(cache_path) >= max(os.path.getmtime(csv_path), os.path.getmtime(arrow_path)):
+        return np.load(cache_path)
+
+    csv_basenames, csv_labels = read_fg_radgraph_csv(csv_path)
+    image_basenames = pc.replace_substring_regex(image_ids, pattern=r"^.*/", replacement="")
+    # search the reversed csv so duplicated basenames resolve to their last line, like a dict would
+    num_csv_rows = len(csv_basenames)
+    positions = pc.index_in(image_basenames, value_set=csv_basenames.take(np.arange(num_csv_rows)[::-1]))
+    positions = positions.fill_null(-1).to_numpy()
+    found = positions >= 0
+    labels = np.zeros((len(positions), len(FG_TEXT_LIST)), dtype=bool)
+    labels[found] = csv_labels[num_csv_rows - 1 - positions[found]]
+
+    packed = np.packbits(labels, axis=1)
+    try:
+        np.save(cache_path, packed)
+    except OSError as e:
+        # read-only or shared data_dir, keep the matrix in memory only
+        print(f"radgraph label cache not written -> {e}")
+    return packed
+
+
 class BaseDataset(torch.utils.data.Dataset):
     def __init__(
             self,
@@ -47,8 +100,16 @@ class BaseDataset(torch.utils.data.Dataset):
             image_only: bool = False,
             label_column_name: str = "",
             max_num_ents: int = 24,
+            image_store: bool = False,
+            index_cache: bool = True,
+            pretokenized: bool = False,
+            quarantine: bool = False,
+            collate_keys: set = None,
+            label_dtype: torch.dtype = torch.uint8,
+            jpeg_draft: bool = False,
     ):
         super().__init__()
+        self.init_timings = dict()
         assert len(transform_keys) >= 1
         # Hyper-Parameters
         self.text_column_name = text_column_name
@@ -60,19 +121,33 @@ class BaseDataset(torch.utils.data.Dataset):
         self.image_only = image_only
         self.data_dir = data_dir
         self.label_column_name = label_column_name
+        # outputs collate builds, e.g. {"image", "text"} or {"text_ids_mlm", "text_labels_mlm"}; None builds all
+        # but the opt-in img_labels_csr / _packed and txt_labels_csr / _packed
+        self.collate_keys = collate_keys
+        # dtype of the dense img_labels / txt_labels, uint8 or bool keeps them 8x smaller than long.
+        # a BCE-style loss needs float targets (labels.float()), torch.long restores the old dtype
+        self.label_dtype = label_dtype
 
         # Image Transformations
         if "train" not in names[0]:
+            transform_keys = [transform_key.replace("_randaug_lut", "") for transform_key in transform_keys]
             transform_keys = [transform_key.replace("_randaug", "") for transform_key in transform_keys]
             transform_keys = [transform_key.replace("_resizedcrop", "") for transform_key in transform_keys]
         self.transforms = keys_to_transforms(transform_keys, size=image_size)
+        # decode JPEGs at the smallest DCT scale (1/2, 1/4, 1/8) still covering image_size, grayscale kept as L
+        self.image_size = image_size
+        self.jpeg_draft = jpeg_draft
         self.clip_transform = False
         for transform_key in transform_keys:
             if 'clip' in transform_key:
                 self.clip_transform = True
                 break
+        # clip_gray* keeps images single-channel from decode to collate, (B, 1, 1, H, W)
+        self.gray = all('gray' in transform_key for transform_key in transform_keys)
         
         # Read Texts
+        start_time = time.perf_counter()
+        tables = list()
         if len(names) != 0:
             tables = [
                 pa.ipc.RecordBatchFileReader(pa.memory_map(f"{data_dir}/pretrain_arrows_umls/{name}.arrow", "r")).read_all()
@@ -83,71 +158,89 @@ class BaseDataset(torch.utils.data.Dataset):
             for i, name in enumerate(names):
                 self.table_names += [name] * len(tables[i])
             self.table = pa.concat_tables(tables, promote=True)
+            self.table_offsets = np.cumsum([0] + [len(table) for table in tables])
+            self.chunk_index = ChunkIndex.from_column(self.table.column(0))
             if text_column_name != "":
                 self.text_column_name = text_column_name
-                self.all_texts = self.table[text_column_name].to_pandas().tolist()
+                self.all_texts = LazyColumn(self.table[text_column_name], self.chunk_index)
                 assert type(self.all_texts[0][0]) == str
             else:
                 self.all_texts = list()
         else:
             self.all_texts = list()
 
+        # Pre-decoded Images, see image_store.build_image_store
+        self.image_store = None
+        if image_store:
+            self.image_store = [load_image_store(data_dir, name, image_size) for name in names]
+            self.image_store_offsets = np.cumsum([0] + [len(images) for images in self.image_store])
+            assert self.image_store_offsets[-1] == len(self.table), \
+                f"image store has {self.image_store_offsets[-1]} images, table has {len(self.table)} rows"
+            if any("resizedcrop" in key or "randaug" in key for key in transform_keys):
+                print(f"image store holds {image_size} centre crops, {transform_keys} crop / augment those "
+                      "instead of the full image")
+
         # Read Entities
-        self.all_img_ents = self.table["img_ents"].to_pandas().tolist()
-        self.all_txt_ents = self.table["txt_ents"].to_pandas().tolist()
+        self.all_img_ents = LazyColumn(self.table["img_ents"], self.chunk_index)
+        self.all_txt_ents = LazyColumn(self.table["txt_ents"], self.chunk_index)
         print('all_img_ents length: ', len(self.all_img_ents))
         print('all_txt_ents length: ', len(self.all_txt_ents))
+        self.init_timings["tables"] = time.perf_counter() - start_time
 
         ########################################################################
-        # read labels
-        fulllabels = open(fr"{data_dir}/fg_radgraph_metric.csv").read().strip().split("\n")[1:]
-        imageid2labels = {os.path.basename(fl.split(',')[0]): fl.split(',')[1: ] for fl in fulllabels}
-        # link labels
-        self.all_fg_radgraph_labels = []
-        fullimageids = self.table["image_id"].to_pandas().tolist()
-        valid_all_fg_radgraph_labels = 0
-        for fiid in fullimageids:
-            iid = os.path.basename(fiid)
-            str_labels = []
-            # str_labels = [os.path.splitext(iid)[0], ]
-            if iid in imageid2labels:
-                this_label_list = imageid2labels[iid]
-                # print(fr'{iid}  -> {this_label_list}')
-                for idx, tl in enumerate(this_label_list):
-                    if eval(tl) >= 1:
-                        str_labels.append(FG_TEXT_LIST[idx])
-                    else:
-                        pass
-            else:
-                pass
-            if len(str_labels) > 0:
-                # print(fr'imageid {iid}, labels {str_labels}')
-                valid_all_fg_radgraph_labels += 1
-            self.all_fg_radgraph_labels.append(str_labels)
-        print('all_fg_radgraph_labels length: ', len(self.all_fg_radgraph_labels), 
-              'validlength: ', valid_all_fg_radgraph_labels)
+        # Derived Indices, reused from the on-disk cache while the input files are unchanged
+        start_time = time.perf_counter()
+        # rows that failed the validation pass (quarantine.build_quarantine), as rows of self.table
+        self.quarantined_rows = None
+        if quarantine:
+            self.quarantined_rows = np.concatenate([
+                load_quarantine(data_dir, name) + offset for name, offset in zip(names, self.table_offsets)
+            ])
+            print('quarantined rows: ', len(self.quarantined_rows))
+        # shared with the DataLoader workers, so the reported total covers every process
+        self.runtime_failure_total = multiprocessing.Value("i", 0)
+
+        indices = None
+        if index_cache:
+            input_files = [f"{data_dir}/pretrain_arrows_umls/{name}.arrow" for name in names] + [
+                f"{data_dir}/fg_radgraph_metric.csv",
+                f"{data_dir}/knowledge/entity2id.txt",
+            ]
+            if quarantine:
+                input_files += [quarantine_path(data_dir, name) for name in names]
+            cache_path = index_cache_path(data_dir, index_cache_key(
+                input_files,
+                dataset=type(self).__name__,
+                names=names,
+                text_column_name=text_column_name,
+                image_only=image_only,
+                quarantine=quarantine,
+            ))
+            indices = load_index_cache(cache_path)
+        self.index_cache_hit = indices is not None
+        if indices is None:
+            indices = self.build_indices(tables)
+            if index_cache:
+                save_index_cache(cache_path, indices)
+        self.set_indices(indices)
+        self.init_timings["indices"] = time.perf_counter() - start_time
+
+        valid_fg_radgraph_labels = np.count_nonzero(self.fg_radgraph_labels.any(axis=1))
+        print('fg_radgraph_labels length: ', len(self.fg_radgraph_labels),
+              'validlength: ', valid_fg_radgraph_labels)
         print('image length: ', len(self.table['image']))
-
-        ########################################################################
-        self.ent2id = open(fr"{data_dir}/knowledge/entity2id.txt").read().strip().split("\n")[1:]
-        self.ent2id = {kv.split("\t")[0]: kv.split("\t")[2] for kv in self.ent2id}
-        self.id2ent = {v: k for k, v in self.ent2id.items()}
-
-        # Record Index Mappings
-        self.index_mapper = dict()
-        if text_column_name != "" and not self.image_only:
-            j = 0
-            for i, texts in enumerate(self.all_texts):
-                for _j in range(len(texts)):
-                    self.index_mapper[j] = (i, _j)
-                    j += 1
-        else:
-            for i in range(len(self.table)):
-                self.index_mapper[i] = (i, None)
         print('index_mapper length: ', len(self.index_mapper))
 
+        # Pre-tokenized Texts, see pretokenize.build_pretokenized
+        self.pretokenized = None
+        if pretokenized:
+            self.pretokenized = PretokenizedText(data_dir, names, max_text_len, self.index_mapper, self.table_offsets)
+            if self.pretokenized.num_missing:
+                print(f"{self.pretokenized.num_missing} samples not pre-tokenized, they are tokenized on the fly")
+
         ###########################################################################################
         # Tokenizer
+        start_time = time.perf_counter()
         tokenizer = 'bert-base-uncased'
         whole_word_masking = True
         mlm_prob = 0.15
@@ -162,9 +255,53 @@ class BaseDataset(torch.utils.data.Dataset):
             else DataCollatorForLanguageModeling
         )
 
-        self.tokenizer = get_pretrained_tokenizer(tokenizer)
         self.mlm_collator = collator(tokenizer=self.tokenizer, mlm=True, mlm_probability=mlm_prob)
+        self.init_timings["tokenizer"] = time.perf_counter() - start_time
         ###########################################################################################
+        print('dataset construction: ' + ', '.join(f'{k} {v:.2f}s' for k, v in self.init_timings.items()),
+              '(index cache hit)' if self.index_cache_hit else '(index cache miss)')
+
+    def build_indices(self, tables):
+        '''derive every per-row / per-sample index from the input files, as a dict of numpy arrays.
+        subclasses extend the dict and consume their entries in set_indices.
+        '''
+        indices = dict()
+        # read labels, bit-packed rows of FG_TEXT_LIST flags aligned to self.table
+        indices["fg_radgraph_labels"] = np.concatenate([
+            load_fg_radgraph_labels(self.data_dir, name, table["image_id"]) for name, table in zip(self.names, tables)
+        ])
+
+        ent_lines = open(fr"{self.data_dir}/knowledge/entity2id.txt").read().strip().split("\n")[1:]
+        indices["num_ents"] = np.array(len({kv.split("\t")[0] for kv in ent_lines}))
+
+        # Record Index Mappings
+        if self.text_column_name != "" and not self.image_only:
+            num_captions = pc.list_value_length(self.table[self.text_column_name]).fill_null(0).to_numpy()
+            index_mapper = IndexMapper.from_caption_counts(num_captions)
+        else:
+            index_mapper = IndexMapper(np.arange(len(self.table)))
+        if self.quarantined_rows is not None:
+            keep = ~np.isin(index_mapper.rows, self.quarantined_rows)
+            index_mapper = IndexMapper(
+                index_mapper.rows[keep], None if index_mapper.captions is None else index_mapper.captions[keep])
+        indices["index_rows"] = index_mapper.rows
+        if index_mapper.captions is not None:
+            indices["index_captions"] = index_mapper.captions
+        return indices
+
+    def set_indices(self, indices):
+        self.fg_radgraph_labels = indices["fg_radgraph_labels"]
+        self.num_ents = int(indices["num_ents"])
+        self.index_mapper = IndexMapper(indices["index_rows"], indices.get("index_captions"))
+
+    @cached_property
+    def ent2id(self):
+        ent2id = open(fr"{self.data_dir}/knowledge/entity2id.txt").read().strip().split("\n")[1:]
+        return {kv.split("\t")[0]: kv.split("\t")[2] for kv in ent2id}
+
+    @cached_property
+    def id2ent(self):
+        return {v: k for k, v in self.ent2id.items()}
 
     @property
     def corpus(self):
@@ -175,19 +312,39 @@ class BaseDataset(torch.utils.data.Dataset):
 
     def get_strlabels(self, index):
         index, caption_index = self.index_mapper[index]
-        return self.all_fg_radgraph_labels[index]
+        flags = np.unpackbits(self.fg_radgraph_labels[index], count=len(FG_TEXT_LIST))
+        return [FG_TEXT_LIST[idx] for idx in np.flatnonzero(flags)]
 
-    def get_raw_image(self, index, image_key="image"):
+    def get_raw_image(self, index, image_key="image", image_bytes=None):
+        '''image_bytes: encoded image of the row when the caller already read it, e.g. StreamingDataset.'''
         index, caption_index = self.index_mapper[index]
-        image_bytes = io.BytesIO(self.table[image_key][index].as_py())
+        if self.image_store is not None and image_key == "image":
+            # grayscale uint8 slice of the memmap, PIL maps it without copying
+            source = np.searchsorted(self.image_store_offsets, index, side="right") - 1
+            return Image.fromarray(self.image_store[source][index - self.image_store_offsets[source]])
+        if image_bytes is None:
+            chunk, offset = self.chunk_index.locate(index)
+            image_bytes = self.table[image_key].chunk(chunk)[offset].as_py()
+        image_bytes = io.BytesIO(image_bytes)
         image_bytes.seek(0)
+        if self.jpeg_draft:
+            image = Image.open(image_bytes)
+            if image.format == "JPEG":
+                # the shorter side stays >= image_size, so Resize in the transforms still sets the final size
+                image.draft(image.mode, (self.image_size, self.image_size))
+            # the clip transforms convert to RGB themselves, a grayscale CXR is decoded as one channel
+            if image.mode in ("L", "RGB"):
+                return image
+            return image.convert("RGB")
+        if self.gray:
+            return Image.open(image_bytes).convert("L")
         if self.clip_transform:
             return Image.open(image_bytes).convert("RGBA")
         else:
             return Image.open(image_bytes).convert("RGB")
 
-    def get_image(self, index, image_key="image"):
-        image = self.get_raw_image(index, image_key=image_key)
+    def get_image(self, index, image_key="image", image_bytes=None):
+        image = self.get_raw_image(index, image_key=image_key, image_bytes=image_bytes)
         image_tensor = [tr(image) for tr in self.transforms]
         return {
             "image": image_tensor,
@@ -202,16 +359,24 @@ class BaseDataset(torch.utils.data.Dataset):
         image_tensor = [tr(image) for tr in self.transforms]
         return {f"false_image_{rep}": image_tensor}
 
-    def get_text(self, raw_index):
+    def get_caption(self, raw_index, with_labels=True):
         index, caption_index = self.index_mapper[raw_index]
         text = self.all_texts[index][caption_index]
 
         #############################################
-        radgraph_text_list = self.get_strlabels(raw_index)
-        if len(radgraph_text_list) > 0:
-            text += fr'. The diagnosis is {" ".join(radgraph_text_list)}.'
+        if with_labels:
+            radgraph_text_list = self.get_strlabels(raw_index)
+            if len(radgraph_text_list) > 0:
+                text += fr'. The diagnosis is {" ".join(radgraph_text_list)}.'
         #############################################
+        return text
 
+    def encode_text(self, raw_index, text, with_labels=True):
+        if self.pretokenized is not None:
+            encoding = self.pretokenized.get(raw_index, with_labels=with_labels)
+            if encoding is not None:
+                return encoding
+        index, caption_index = self.index_mapper[raw_index]
         encoding = self.tokenizer(
             text,
             padding="max_length",
@@ -220,13 +385,15 @@ class BaseDataset(torch.utils.data.Dataset):
             return_special_tokens_mask=True,
             return_offsets_mapping=True,
         )
-        encoding = record_ent_ref(encoding, self.all_txt_ents[index][caption_index])
-        img_label = torch.zeros(len(self.ent2id), dtype=torch.long)
-        txt_label = torch.zeros(len(self.ent2id), dtype=torch.long)
-        for label_index in self.all_img_ents[index]:
-            img_label[label_index] = 1
-        for label_index in encoding["txt_label"]:
-            txt_label[label_index] = 1
+        return record_ent_ref(encoding, self.all_txt_ents[index][caption_index])
+
+    def get_text(self, raw_index):
+        index, caption_index = self.index_mapper[raw_index]
+        text = self.get_caption(raw_index)
+        encoding = self.encode_text(raw_index, text)
+        # entity indices only, collate turns the batch into CSR and densifies on request
+        img_label = np.asarray(self.all_img_ents[index], dtype=np.int32)
+        txt_label = np.asarray(encoding["txt_label"], dtype=np.int32)
         return {
             "text": (text, encoding),
             "img_index": index,
@@ -238,25 +405,16 @@ class BaseDataset(torch.utils.data.Dataset):
 
     def get_false_text(self, rep, selected_index=None):
         random_index = random.randint(0, len(self.index_mapper) - 1)
-        index, caption_index = self.index_mapper[random_index]
-        text = self.all_texts[index][caption_index]
-        encoding = self.tokenizer(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=self.max_text_len,
-            return_special_tokens_mask=True,
-            return_offsets_mapping=True,
-        )
-        encoding = record_ent_ref(encoding, self.all_txt_ents[index][caption_index])
+        text = self.get_caption(random_index, with_labels=False)
+        encoding = self.encode_text(random_index, text, with_labels=False)
         return {f"false_text_{rep}": (text, encoding)}
 
-    def get_suite(self, index):
+    def get_suite(self, index, image_bytes=None):
         result = None
         while result is None:
             try:
                 ret = dict()
-                ret.update(self.get_image(index))
+                ret.update(self.get_image(index, image_bytes=image_bytes))
                 if not self.image_only:
                     txt = self.get_text(index)
                     ret.update({"replica": True if txt["cap_index"] > 0 else False})
@@ -267,16 +425,53 @@ class BaseDataset(torch.utils.data.Dataset):
                     ret.update(self.get_false_text(i, selected_index=index))
                 result = True
             except Exception as e:
-                print(f"Error while read file idx {index} in {self.names[0]} -> {e}")
+                with self.runtime_failure_total.get_lock():
+                    self.runtime_failure_total.value += 1
+                print(f"Error while read file idx {index} in {self.names[0]} -> {e}",
+                      f"({self.runtime_failure_total.value} runtime failures in all workers)")
                 index = random.randint(0, len(self.index_mapper) - 1)
+                image_bytes = None
         return ret
 
+    def collate_wants(self, key):
+        return self.collate_keys is None or key in self.collate_keys
+
+    def collate_wants_any(self, prefix, suffixes):
+        return any(self.collate_wants(f"{prefix}{suffix}") for suffix in suffixes)
+
+    def collate_sources(self, sample_keys):
+        '''sample keys the requested collate_keys are built from, e.g. img_labels_csr needs img_label and
+        text_ids_mlm needs text. raises on a requested output no sample key produces.
+        '''
+        label_suffixes = ["s", "s_csr", "s_packed"]
+        text_suffixes = ["_ids", "_labels", "_masks", "_ids_mlm", "_labels_mlm", "_pos_matrices", "_ent_ids",
+                         "_ent_masks", "_pos_matrices_mlm", "_ent_ids_mlm", "_ent_masks_mlm"]
+        sources, unknown = set(), set()
+        for out in self.collate_keys:
+            found = set()
+            if out in sample_keys:
+                found.add(out)
+            for key in sample_keys:
+                if key in ["img_label", "txt_label"] and out in [f"{key}{suffix}" for suffix in label_suffixes]:
+                    found.add(key)
+                if "text" in key and out in [f"{key}{suffix}" for suffix in text_suffixes]:
+                    found.add(key)
+            if len(found) == 0:
+                unknown.add(out)
+            sources |= found
+        if len(unknown) != 0:
+            raise ValueError(f"collate_keys {sorted(unknown)} are not built from any of {sorted(sample_keys)}")
+        return sources
+
     def collate(self, batch, mlm_collator=None):
         if mlm_collator is None:
             mlm_collator = self.mlm_collator
 
         batch_size = len(batch)
         keys = set([key for b in batch for key in b.keys()])
+        if self.collate_keys is not None:
+            # sample keys no requested output is derived from are dropped, e.g. img_index or false_image_0
+            keys = self.collate_sources(keys)
         dict_batch = {k: [dic[k] if k in dic else None for dic in batch] for k in keys}
 
         img_keys = [k for k in list(dict_batch.keys()) if "image" in k]
@@ -287,9 +482,10 @@ class BaseDataset(torch.utils.data.Dataset):
             img_sizes += [ii.shape for i in img if i is not None for ii in i]
 
         for size in img_sizes:
-            assert (len(size) == 3), f"Collate error, an image should be in shape of (3, H, W), instead of given {size}"
+            assert (len(size) == 3), f"Collate error, an image should be in shape of (C, H, W), instead of given {size}"
 
         if len(img_keys) != 0:
+            num_channels = img_sizes[0][0]
             max_height = max([i[1] for i in img_sizes])
             max_width = max([i[2] for i in img_sizes])
 
@@ -299,7 +495,7 @@ class BaseDataset(torch.utils.data.Dataset):
             img = dict_batch[img_key]
             view_size = len(img[0])
             # new_images = [torch.zeros(batch_size, 3, max_height, max_width) for _ in range(view_size)]
-            new_images = [torch.zeros(batch_size, IMAGE_DEPTH, 3, max_height, max_width) for _ in range(view_size)]
+            new_images = [torch.zeros(batch_size, IMAGE_DEPTH, num_channels, max_height, max_width) for _ in range(view_size)]
             for bi in range(batch_size):
                 orig_batch = img[bi]
                 for vi in range(view_size):
@@ -314,45 +510,35 @@ class BaseDataset(torch.utils.data.Dataset):
             dict_batch[img_key] = new_images
         #####################################################################
 
-        if "text" in dict_batch:
-            dict_batch["img_labels"] = torch.vstack([d["img_label"] for d in batch])
-            dict_batch["txt_labels"] = torch.vstack([d["txt_label"] for d in batch])
+        for key in ["img_label", "txt_label"]:
+            # {key}s dense (label_dtype), {key}s_csr (offsets, indices), {key}s_packed one bit per entity.
+            # _csr and _packed are only built when named in collate_keys
+            wants_csr = self.collate_keys is not None and f"{key}s_csr" in self.collate_keys
+            wants_packed = self.collate_keys is not None and f"{key}s_packed" in self.collate_keys
+            if key not in dict_batch or not (self.collate_wants(f"{key}s") or wants_csr or wants_packed):
+                continue
+            offsets, indices = labels_to_csr(dict_batch[key])
+            if self.collate_wants(f"{key}s"):
+                dict_batch[f"{key}s"] = csr_to_dense(offsets, indices, self.num_ents, self.label_dtype)
+            if wants_csr:
+                dict_batch[f"{key}s_csr"] = (offsets, indices)
+            if wants_packed:
+                dict_batch[f"{key}s_packed"] = csr_to_packed(offsets, indices, self.num_ents)
 
         txt_keys = [k for k in list(dict_batch.keys()) if "text" in k]
-        if len(txt_keys) != 0:
-            encodings = [[d[1] for d in dict_batch[txt_key]] for txt_key in txt_keys]
-            flatten_encodings = [e for encoding in encodings for e in encoding]
-            flatten_mlms = mlm_collator(flatten_encodings)
-
-            ent_inputs, ent_inputs_mlm = [], []
-            for e, m in zip(flatten_encodings, flatten_mlms["labels"]):
-                ent_inputs.append(create_pos_matrix(e, self.max_text_len, self.max_num_ents))
-                ent_inputs_mlm.append(create_pos_matrix(e, self.max_text_len, self.max_num_ents, m))
-            flatten_pos_matrices = torch.stack([item[0] for item in ent_inputs])
-            flatten_ent_ids = torch.stack([item[1] for item in ent_inputs])
-            flatten_ent_masks = torch.stack([item[2] for item in ent_inputs])
-            flatten_pos_matrices_mlm = torch.stack([item[0] for item in ent_inputs_mlm])
-            flatten_ent_ids_mlm = torch.stack([item[1] for item in ent_inputs_mlm])
-            flatten_ent_masks_mlm = torch.stack([item[2] for item in ent_inputs_mlm])
-            for i, txt_key in enumerate(txt_keys):
-                texts, encodings = ([d[0] for d in dict_batch[txt_key]], [d[1] for d in dict_batch[txt_key]])
-                mlm_ids, mlm_labels = (
-                    flatten_mlms["input_ids"][batch_size * (i): batch_size * (i + 1)],
-                    flatten_mlms["labels"][batch_size * (i): batch_size * (i + 1)],
-                )
-                pos_matrices, ent_ids, ent_masks = (
-                    flatten_pos_matrices[batch_size * (i): batch_size * (i + 1)],
-                    flatten_ent_ids[batch_size * (i): batch_size * (i + 1)],
-                    flatten_ent_masks[batch_size * (i): batch_size * (i + 1)],
-                )
-                pos_matrices_mlm, ent_ids_mlm, ent_masks_mlm = (
-                    flatten_pos_matrices_mlm[batch_size * (i): batch_size * (i + 1)],
-                    flatten_ent_ids_mlm[batch_size * (i): batch_size * (i + 1)],
-                    flatten_ent_masks_mlm[batch_size * (i): batch_size * (i + 1)],
-                )
-
-                input_ids = torch.zeros_like(mlm_ids)
-                attention_mask = torch.zeros_like(mlm_ids)
+        mlm_suffixes = ["_ids_mlm", "_labels_mlm", "_pos_matrices_mlm", "_ent_ids_mlm", "_ent_masks_mlm"]
+        mlm_keys = [k for k in txt_keys if self.collate_wants_any(k, mlm_suffixes)]
+        if len(mlm_keys) != 0:
+            # one masking pass over all texts, as before keys were selectable
+            flatten_mlms = mlm_collator([d[1] for txt_key in mlm_keys for d in dict_batch[txt_key]])
+
+        for txt_key in txt_keys:
+            texts, encodings = ([d[0] for d in dict_batch[txt_key]], [d[1] for d in dict_batch[txt_key]])
+            dict_batch[txt_key] = texts
+
+            if self.collate_wants_any(txt_key, ["_ids", "_labels", "_masks"]):
+                input_ids = torch.zeros((batch_size, max(len(e["input_ids"]) for e in encodings)), dtype=torch.long)
+                attention_mask = torch.zeros_like(input_ids)
                 for _i, encoding in enumerate(encodings):
                     _input_ids, _attention_mask = (
                         torch.tensor(encoding["input_ids"]),
@@ -360,19 +546,28 @@ class BaseDataset(torch.utils.data.Dataset):
                     )
                     input_ids[_i, : len(_input_ids)] = _input_ids
                     attention_mask[_i, : len(_attention_mask)] = _attention_mask
-
-                dict_batch[txt_key] = texts
                 dict_batch[f"{txt_key}_ids"] = input_ids
                 dict_batch[f"{txt_key}_labels"] = torch.full_like(input_ids, -100)
-                dict_batch[f"{txt_key}_ids_mlm"] = mlm_ids
-                dict_batch[f"{txt_key}_labels_mlm"] = mlm_labels
                 dict_batch[f"{txt_key}_masks"] = attention_mask
 
+            mlm_labels = None
+            if txt_key in mlm_keys:
+                i = mlm_keys.index(txt_key)
+                mlm_labels = flatten_mlms["labels"][batch_size * (i): batch_size * (i + 1)]
+                dict_batch[f"{txt_key}_ids_mlm"] = flatten_mlms["input_ids"][batch_size * (i): batch_size * (i + 1)]
+                dict_batch[f"{txt_key}_labels_mlm"] = mlm_labels
+
+            if self.collate_wants_any(txt_key, ["_pos_matrices", "_ent_ids", "_ent_masks"]):
+                pos_matrices, ent_ids, ent_masks = create_pos_matrices(encodings, self.max_text_len, self.max_num_ents)
                 dict_batch[f"{txt_key}_pos_matrices"] = pos_matrices
                 dict_batch[f"{txt_key}_ent_ids"] = ent_ids
                 dict_batch[f"{txt_key}_ent_masks"] = ent_masks
-                dict_batch[f"{txt_key}_pos_matrices_mlm"] = pos_matrices_mlm
-                dict_batch[f"{txt_key}_ent_ids_mlm"] = ent_ids_mlm
-                dict_batch[f"{txt_key}_ent_masks_mlm"] = ent_masks_mlm
+
+            if mlm_labels is not None and self.collate_wants_any(txt_key, mlm_suffixes[2:]):
+                pos_matrices, ent_ids, ent_masks = create_pos_matrices(
+                    encodings, self.max_text_len, self.max_num_ents, mlm_labels)
+                dict_batch[f"{txt_key}_pos_matrices_mlm"] = pos_matrices
+                dict_batch[f"{txt_key}_ent_ids_mlm"] = ent_ids
+                dict_batch[f"{txt_key}_ent_masks_mlm"] = ent_masks
 
         return dict_batch
@@ -256,6 +256,17 @@ class DataCollatorForWholeEntityMask(DataCollatorForLanguageModeling):
     - preprocesses batches for masked language modeling
     """
 
+    # group sampling over tensors with vocabulary lookup tables; False keeps the per-token python reference
+    # path with its fixed per-sequence budget
+    tensorized: bool = True
+
+    def __post_init__(self):
+        super().__post_init__()
+        vocab = self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))
+        self.continuation_lut = torch.tensor([token.startswith("##") for token in vocab], dtype=torch.bool)
+        self.special_lut = torch.zeros(len(vocab), dtype=torch.bool)
+        self.special_lut[self.tokenizer.all_special_ids] = True
+
     def __call__(
             self, examples: List[Union[List[int], torch.Tensor, Dict[str, torch.Tensor]]]
     ) -> Dict[str, torch.Tensor]:
@@ -267,6 +278,18 @@ class DataCollatorForWholeEntityMask(DataCollatorForLanguageModeling):
 
         batch_input = _collate_batch(input_ids, self.tokenizer)
 
+        if self.tensorized:
+            ent_ref = torch.zeros(batch_input.shape, dtype=torch.bool)
+            for i, e in enumerate(examples):
+                if "ent_ref" in e:
+                    ref = torch.as_tensor(tolist(e["ent_ref"]), dtype=torch.bool)
+                    if self.tokenizer.padding_side == "right":
+                        ent_ref[i, : len(ref)] = ref
+                    else:
+                        ent_ref[i, -len(ref):] = ref
+            inputs, labels = self.mask_tokens(batch_input, self._whole_entity_mask(batch_input, ent_ref))
+            return {"input_ids": inputs, "labels": labels}
+
         mask_labels = []
         for e in examples:
             ref_tokens = []
@@ -287,6 +310,21 @@ class DataCollatorForWholeEntityMask(DataCollatorForLanguageModeling):
         inputs, labels = self.mask_tokens(batch_input, batch_mask)
         return {"input_ids": inputs, "labels": labels}
 
+    def _whole_entity_mask(self, inputs: torch.Tensor, ent_ref: torch.Tensor) -> torch.Tensor:
+        """
+        Get 0/1 labels for a whole batch: a word (or entity) starts at every non-special token that is not a
+        continuation, every word is kept with probability mlm_probability and its tokens follow its first token
+        """
+        special = self.special_lut[inputs]
+        continuation = self.continuation_lut[inputs] | ent_ref
+        previous_special = torch.nn.functional.pad(special[:, :-1], (1, 0), value=True)
+        starts = ~special & (~continuation | previous_special)
+
+        positions = torch.arange(inputs.shape[1]).expand_as(inputs)
+        word_starts = torch.where(starts, positions, torch.zeros_like(positions)).cummax(dim=1).values
+        selected = torch.bernoulli(torch.full(inputs.shape, self.mlm_probability)).bool() & starts
+        return (selected.gather(1, word_starts) & ~special).long()
+
     def _whole_word_mask(self, input_tokens: List[str], max_predictions=512):
         """
         Get 0/1 labels for masked tokens with whole word mask proxy
@@ -343,10 +381,8 @@ class DataCollatorForWholeEntityMask(DataCollatorForLanguageModeling):
 
         probability_matrix = mask_labels
 
-        special_tokens_mask = [
-            self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-        ]
-        probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+        special_tokens_mask = self.special_lut[labels]
+        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
         if self.tokenizer._pad_token is not None:
             padding_mask = labels.eq(self.tokenizer.pad_token_id)
             probability_matrix.masked_fill_(padding_mask, value=0.0)
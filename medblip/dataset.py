@@ -1,56 +1,107 @@
+import random
 from collections import defaultdict
-import torch.nn.functional as F
 import torch
 from torch.utils.data import Dataset
 
-import SimpleITK as sitk
+from .volume_store import (
+    VolumeStore, load_bbox_index, read_datalist, read_volume, read_volume_bbox,
+    norm_img, pad_img, pad_img_batch, pad_img_bbox, take_slabs,
+)
+from .prefetch import VolumePrefetcher
 
 class ImageTextContrastiveDataset(Dataset):
 
-    def __init__(self, datalist=['ADNI-train']) -> None:
+    def __init__(self, datalist=['ADNI-train'], volume_store=False, pad_in_collate=False, foreground_bbox=False,
+        slab_positions=None, slab_thickness=8, subvolume_size=None, subvolume_stride=16,
+        prefetch_threads=0, prefetch_depth=16) -> None:
         super().__init__()
         # imgpath, report
-        df_list = []
-        for data in datalist:
-            filename = f'./local_data/{data}.csv'
-            print('load data from', filename)
-            with open(filename) as f:
-                lines = f.readlines()
-                for line in lines:
-                    imgpath,report = line.strip('\n').split('\t')
-                    df_list.append((imgpath,report))
-
-        self.df = df_list
+        self.df = read_datalist(datalist)
+        # return [x, y, z] volumes and leave resizing to ImageTextContrastiveCollator(pad_in_collate=True)
+        self.pad_in_collate = pad_in_collate
+
+        # normalized 224^3 volumes written by volume_store.build_volume_store
+        self.volume_store = VolumeStore(datalist) if volume_store else None
+        if self.volume_store is not None:
+            assert len(self.volume_store) == len(self.df)
+
+        # fractional positions of the slabs averaged into a (1, 1, 3, 224, 224) input for the CXR-sized ViT path
+        self.slab_positions = slab_positions
+        self.slab_thickness = slab_thickness
+        if slab_positions is not None:
+            assert not pad_in_collate, "slabs are taken from the padded volume"
+
+        # random (d, h, w) crop of the stored volume per sample, returned with its voxel start for the pos embedding.
+        # starts are multiples of subvolume_stride (int or (d, h, w)), which has to be a multiple of the patch size
+        # the ViT actually uses after fit_patch_size, e.g. subvolume_stride=model.visual_encoder.patch_embed_3d.patch_size
+        self.subvolume_size = subvolume_size
+        self.subvolume_stride = tuple(subvolume_stride) if isinstance(subvolume_stride, (tuple, list)) else (subvolume_stride,) * 3
+        if subvolume_size is not None:
+            assert volume_store and not pad_in_collate and slab_positions is None, "sub-volumes are read from the volume store"
+
+        # foreground boxes written by volume_store.build_bbox_index, only the box is read and resampled
+        self.bboxes = None
+        if foreground_bbox:
+            assert not pad_in_collate, "foreground_bbox resamples in __getitem__"
+            self.bboxes, self.vranges = load_bbox_index(datalist)
+            assert len(self.bboxes) == len(self.df)
+
+        # NIfTI reads + gzip decompression on a thread pool, fed by __getitems__ or prefetch.PrefetchSampler
+        # (num_workers=0) / prefetch.PrefetchBatchSampler (worker processes)
+        self.prefetcher = None
+        if prefetch_threads > 0 and not volume_store:
+            self.prefetcher = VolumePrefetcher(self.read_nifti, prefetch_depth, prefetch_threads)
 
     def pad_img(self, img, size=224):
         '''pad img to square.
         '''
-        x, y, z = img.shape
-        img = img.unsqueeze(0).unsqueeze(0) # BCHWD
-        max_size = max(x, y, z)
-        new_size = (int(size*x/max_size), int(size*y/max_size), int(size*z/max_size))
-        img = F.interpolate(img,size=new_size,mode='trilinear',align_corners=True)
-
-        x,y,z = new_size
-        new_im = torch.zeros((1,1,size,size,size))
-        x_min = int((size - x) / 2)
-        x_max = x_min + x
-        y_min = int((size - y) / 2)
-        y_max = y_min + y
-        z_min = int((size - z) / 2)
-        z_max = z_min + z
-        new_im[:,:,x_min:x_max,y_min:y_max,z_min:z_max] = img
-        
-        return new_im
+        return pad_img(img, size)
     
     def norm_img(self, img):
-        return (img - img.min())/(img.max() - img.min())
+        return norm_img(img)
+
+    def read_nifti(self, index):
+        imgpath,report = self.df[index]
+        if self.bboxes is not None:
+            return read_volume_bbox(imgpath, self.bboxes[index])
+        return read_volume(imgpath)
+
+    def load_nifti(self, index):
+        if self.prefetcher is not None:
+            return self.prefetcher.get(index)
+        return self.read_nifti(index)
+
+    def __getitems__(self, indices):
+        # a DataLoader worker hands over the whole batch, read it on the prefetcher threads, together with
+        # the worker's next batch when the indices come from prefetch.PrefetchBatchSampler
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(indices)
+            self.prefetcher.schedule(getattr(indices, "upcoming", []))
+        return [self[index] for index in indices]
 
     def __getitem__(self, index):
         imgpath,report = self.df[index]
-        img = torch.FloatTensor(sitk.GetArrayFromImage(sitk.ReadImage(imgpath)).astype(float))
-        img = self.norm_img(img)
-        img = self.pad_img(img)
+        if self.subvolume_size is not None:
+            size = self.volume_store.volumes[0].shape[1:]
+            start = [t * random.randint(0, (s - c) // t)
+                for s, c, t in zip(size, self.subvolume_size, self.subvolume_stride)]
+            return self.volume_store.crop(index, start, self.subvolume_size), report, torch.tensor(start)
+        if self.volume_store is not None and self.slab_positions is not None:
+            return self.volume_store.slabs(index, self.slab_positions, self.slab_thickness), report
+        if self.volume_store is not None:
+            img = self.volume_store[index]
+            return (img[0, 0] if self.pad_in_collate else img), report
+        if self.bboxes is not None:
+            img, lo, hi = self.load_nifti(index)
+            img = pad_img_bbox(img, self.bboxes[index], self.vranges[index], lo, hi)
+        else:
+            img = self.load_nifti(index)
+            img = self.norm_img(img)
+            if self.pad_in_collate:
+                return img, report
+            img = self.pad_img(img)
+        if self.slab_positions is not None:
+            img = take_slabs(img[0, 0], self.slab_positions, self.slab_thickness)
         
         return img, report
 
@@ -58,66 +109,115 @@ class ImageTextContrastiveDataset(Dataset):
         return len(self.df)
 
 class ImageTextContrastiveCollator:
-    def __init__(self):
-        return
+    def __init__(self, pad_in_collate=False, size=224):
+        '''pad_in_collate: resize + pad the [x, y, z] volumes of a dataset built with
+        pad_in_collate=True batched, into one batch tensor allocated per call.
+        '''
+        self.pad_in_collate = pad_in_collate
+        self.size = size
     def __call__(self, batch):
         inputs = defaultdict(list)
         for data in batch:
             inputs['images'].append(data[0])
             inputs['reports'].append(data[1])
+            if len(data) > 2:
+                inputs['coords'].append(data[2])
 
-        inputs['images'] = torch.cat(inputs['images'], 0)
+        if 'coords' in inputs:
+            inputs['coords'] = torch.stack(inputs['coords'])
+        if self.pad_in_collate:
+            out = torch.empty((len(batch), 1, self.size, self.size, self.size))
+            inputs['images'] = pad_img_batch(inputs['images'], out)
+        else:
+            inputs['images'] = torch.cat(inputs['images'], 0)
 
         return inputs
 
 class ZeroShotImageDataset(Dataset):
     def __init__(self,
-        datalist=['ADNI-train']
+        datalist=['ADNI-train'],
+        volume_store=False,
+        pad_in_collate=False,
+        foreground_bbox=False,
+        slab_positions=None,
+        slab_thickness=8,
+        prefetch_threads=0,
+        prefetch_depth=16,
         ) -> None:
         super().__init__()
 
-        df_list = []
-        for data in datalist:
-            filename = f'./local_data/{data}.csv'
-            print('load data from', filename)
-            with open(filename) as f:
-                lines = f.readlines()
-                for line in lines:
-                    imgpath,report = line.strip('\n').split('\t')
-                    df_list.append((imgpath,report))
-        self.df = df_list
+        self.df = read_datalist(datalist)
+        self.pad_in_collate = pad_in_collate
+
+        self.volume_store = VolumeStore(datalist) if volume_store else None
+        if self.volume_store is not None:
+            assert len(self.volume_store) == len(self.df)
+
+        # fractional positions of the slabs averaged into a (1, 1, 3, 224, 224) input for the CXR-sized ViT path
+        self.slab_positions = slab_positions
+        self.slab_thickness = slab_thickness
+        if slab_positions is not None:
+            assert not pad_in_collate, "slabs are taken from the padded volume"
+
+        # foreground boxes written by volume_store.build_bbox_index, only the box is read and resampled
+        self.bboxes = None
+        if foreground_bbox:
+            assert not pad_in_collate, "foreground_bbox resamples in __getitem__"
+            self.bboxes, self.vranges = load_bbox_index(datalist)
+            assert len(self.bboxes) == len(self.df)
+
+        # NIfTI reads + gzip decompression on a thread pool, fed by __getitems__ or prefetch.PrefetchSampler
+        # (num_workers=0) / prefetch.PrefetchBatchSampler (worker processes)
+        self.prefetcher = None
+        if prefetch_threads > 0 and not volume_store:
+            self.prefetcher = VolumePrefetcher(self.read_nifti, prefetch_depth, prefetch_threads)
 
     def pad_img(self, img, size=224):
         '''pad img to square.
         '''
-
-        x, y, z = img.shape
-        img = img.unsqueeze(0).unsqueeze(0) # BCHWD
-        max_size = max(x, y, z)
-        new_size = (int(size*x/max_size), int(size*y/max_size), int(size*z/max_size))
-        img = F.interpolate(img,size=new_size,mode='trilinear',align_corners=True)
-
-        x,y,z = new_size
-        new_im = torch.zeros((1,1,size,size,size))
-        x_min = int((size - x) / 2)
-        x_max = x_min + x
-        y_min = int((size - y) / 2)
-        y_max = y_min + y
-        z_min = int((size - z) / 2)
-        z_max = z_min + z
-        new_im[:,:,x_min:x_max,y_min:y_max,z_min:z_max] = img
-        
-        return new_im
+        return pad_img(img, size)
     
     def norm_img(self, img):
-        return (img - img.min())/(img.max() - img.min())
+        return norm_img(img)
+
+    def read_nifti(self, index):
+        imgpath,report = self.df[index]
+        if self.bboxes is not None:
+            return read_volume_bbox(imgpath, self.bboxes[index])
+        return read_volume(imgpath)
+
+    def load_nifti(self, index):
+        if self.prefetcher is not None:
+            return self.prefetcher.get(index)
+        return self.read_nifti(index)
+
+    def __getitems__(self, indices):
+        # a DataLoader worker hands over the whole batch, read it on the prefetcher threads, together with
+        # the worker's next batch when the indices come from prefetch.PrefetchBatchSampler
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(indices)
+            self.prefetcher.schedule(getattr(indices, "upcoming", []))
+        return [self[index] for index in indices]
 
 
     def __getitem__(self, index):
         imgpath,report = self.df[index]
-        img = torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(imgpath)).astype(float))
-        img = self.norm_img(img)
-        img = self.pad_img(img)
+        if self.volume_store is not None and self.slab_positions is not None:
+            return self.volume_store.slabs(index, self.slab_positions, self.slab_thickness), report
+        if self.volume_store is not None:
+            img = self.volume_store[index]
+            return (img[0, 0] if self.pad_in_collate else img), report
+        if self.bboxes is not None:
+            img, lo, hi = self.load_nifti(index)
+            img = pad_img_bbox(img, self.bboxes[index], self.vranges[index], lo, hi)
+        else:
+            img = self.load_nifti(index)
+            img = self.norm_img(img)
+            if self.pad_in_collate:
+                return img, report
+            img = self.pad_img(img)
+        if self.slab_positions is not None:
+            img = take_slabs(img[0, 0], self.slab_positions, self.slab_thickness)
 
         return img, report
 
@@ -125,8 +225,9 @@ class ZeroShotImageDataset(Dataset):
         return len(self.df)
 
 class ZeroShotImageCollator:
-    def __init__(self):
-        return
+    def __init__(self, pad_in_collate=False, size=224):
+        self.pad_in_collate = pad_in_collate
+        self.size = size
     
     def __call__(self, batch):
         inputs = defaultdict(list)
@@ -134,7 +235,11 @@ class ZeroShotImageCollator:
             inputs['images'].append(data[0])
             inputs['reports'].append(data[1])
 
-        inputs['images'] = torch.cat(inputs['images'], 0)
+        if self.pad_in_collate:
+            out = torch.empty((len(batch), 1, self.size, self.size, self.size))
+            inputs['images'] = pad_img_batch(inputs['images'], out)
+        else:
+            inputs['images'] = torch.cat(inputs['images'], 0)
 
         return inputs
 
@@ -64,9 +64,14 @@ class Mlp(nn.Module):
 class Attention(nn.Module):
     def __init__(
             self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
-            proj_drop=0., window_size=None, attn_head_dim=None):
+            proj_drop=0., window_size=None, attn_head_dim=None, attn_mode='dense', attn_window=(4, 4, 4), attn_axis=0):
         super().__init__()
         self.num_heads = num_heads
+        # 'dense', 'window' (local attn_window of the patch grid) or 'axial' (lines along attn_axis)
+        assert attn_mode in ('dense', 'window', 'axial')
+        self.attn_mode = attn_mode
+        self.attn_window = attn_window
+        self.attn_axis = attn_axis
         head_dim = dim // num_heads
         if attn_head_dim is not None:
             head_dim = attn_head_dim
@@ -115,7 +120,49 @@ class Attention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x, rel_pos_bias=None):
+    def local_window(self, grid):
+        if self.attn_mode == 'axial':
+            return tuple(g if axis == self.attn_axis else 1 for axis, g in enumerate(grid))
+        return tuple(min(w, g) for w, g in zip(self.attn_window, grid))
+
+    def local_attention(self, q, k, v, grid):
+        """ Patch tokens attend to their (D, H, W) window and the cls token, the cls token attends to everything
+        """
+        B, H, N, _ = q.shape
+        window = self.local_window(grid)
+        padded = [g + (-g) % w for g, w in zip(grid, window)]
+        blocks = [p // w for p, w in zip(padded, window)]
+
+        def partition(t):
+            t = t[:, :, 1:].reshape(*t.shape[:2], *grid, -1)
+            t = F.pad(t, (0, 0, 0, padded[2] - grid[2], 0, padded[1] - grid[1], 0, padded[0] - grid[0]))
+            t = t.view(*t.shape[:2], blocks[0], window[0], blocks[1], window[1], blocks[2], window[2], -1)
+            t = t.permute(0, 1, 2, 4, 6, 3, 5, 7, 8)
+            return t.reshape(*t.shape[:2], math.prod(blocks), math.prod(window), -1)
+
+        qw, kw, vw = partition(q), partition(k), partition(v)
+        num_windows = qw.shape[2]
+        kw = torch.cat((k[:, :, None, :1].expand(-1, -1, num_windows, -1, -1), kw), dim=3)
+        vw = torch.cat((v[:, :, None, :1].expand(-1, -1, num_windows, -1, -1), vw), dim=3)
+
+        attn = qw @ kw.transpose(-2, -1)
+        if padded != list(grid):
+            # padding keys are masked out, the cls key is always valid
+            valid = partition(torch.ones((1, 1, N, 1), device=q.device)).transpose(-2, -1)
+            valid = F.pad(valid, (1, 0), value=1.) > 0
+            attn = attn.masked_fill(~valid, float('-inf'))
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+        x = attn @ vw
+
+        x = x.view(B, H, *blocks, *window, -1).permute(0, 1, 2, 5, 3, 6, 4, 7, 8)
+        x = x.reshape(B, H, *padded, -1)[:, :, :grid[0], :grid[1], :grid[2]].reshape(B, H, N - 1, -1)
+
+        cls_attn = (q[:, :, :1] @ k.transpose(-2, -1)).softmax(dim=-1)
+        cls_attn = self.attn_drop(cls_attn)
+        return torch.cat((cls_attn @ v, x), dim=2)
+
+    def forward(self, x, rel_pos_bias=None, grid=None):
         B, N, C = x.shape
         qkv_bias = None
         if self.q_bias is not None:
@@ -126,6 +173,14 @@ class Attention(nn.Module):
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
+        if self.attn_mode != 'dense':
+            assert grid is not None and self.relative_position_bias_table is None and rel_pos_bias is None, \
+                "local attention needs the patch grid and no relative position bias"
+            x = self.local_attention(q, k, v, grid).transpose(1, 2).reshape(B, N, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         attn = (q @ k.transpose(-2, -1))
 
         if self.relative_position_bias_table is not None:
@@ -152,12 +207,13 @@ class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
                  drop_path=0., init_values=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-                 window_size=None, attn_head_dim=None):
+                 window_size=None, attn_head_dim=None, attn_mode='dense', attn_window=(4, 4, 4), attn_axis=0):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
-            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim)
+            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim,
+            attn_mode=attn_mode, attn_window=attn_window, attn_axis=attn_axis)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -170,26 +226,27 @@ class Block(nn.Module):
         else:
             self.gamma_1, self.gamma_2 = None, None
 
-    def forward(self, x, rel_pos_bias=None):
+    def forward(self, x, rel_pos_bias=None, grid=None):
         if self.gamma_1 is None:
-            x = x + self.drop_path(self.attn(self.norm1(x), rel_pos_bias=rel_pos_bias))
+            x = x + self.drop_path(self.attn(self.norm1(x), rel_pos_bias=rel_pos_bias, grid=grid))
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         else:
-            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x), rel_pos_bias=rel_pos_bias))
+            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x), rel_pos_bias=rel_pos_bias, grid=grid))
             x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
         return x
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
-    def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768):
+    def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768, in_depth=3):
         
         super().__init__()
         # img_size = to_3tuple(img_size)
         # patch_size = to_3tuple(patch_size)
 
-        img_size = (3, img_size, img_size)
-        patch_size = (3, patch_size, patch_size)
+        # in_depth=1 for single-channel (clip_gray) images, see fold_patch_embed_depth
+        img_size = (in_depth, img_size, img_size)
+        patch_size = (in_depth, patch_size, patch_size)
         num_patches = (img_size[2] // patch_size[2]) * (img_size[1] // patch_size[1]) * (img_size[0] // patch_size[0])
         self.patch_shape = (img_size[0] // patch_size[0], img_size[1] // patch_size[1], img_size[2] // patch_size[2])
         self.img_size = img_size
@@ -207,6 +264,102 @@ class PatchEmbed(nn.Module):
         return x
 
 
+def fit_patch_size(img_size, patch_size, max_tokens=None):
+    """ Coarsen the patch along the axis with the most patches until the grid fits max_tokens
+    """
+    patch_size = list(patch_size)
+    grid = [i // p for i, p in zip(img_size, patch_size)]
+    while max_tokens is not None and math.prod(grid) > max_tokens:
+        axis = max(range(3), key=lambda a: grid[a] if patch_size[a] < img_size[a] else -1)
+        if patch_size[axis] >= img_size[axis]:
+            raise ValueError(f"a single patch of {img_size} cannot fit {max_tokens} tokens")
+        patch_size[axis] = min(patch_size[axis] * 2, img_size[axis])
+        grid[axis] = img_size[axis] // patch_size[axis]
+    return tuple(patch_size), tuple(grid)
+
+
+class VolumePatchEmbed(nn.Module):
+    """ Volume to Patch Embedding with anisotropic (D, H, W) patches and a token budget
+    """
+    def __init__(self, img_size=(224, 224, 224), patch_size=(16, 16, 16), in_chans=1, embed_dim=768, max_tokens=None):
+        super().__init__()
+        img_size = to_3tuple(img_size)
+        requested_patch_size = to_3tuple(patch_size)
+        patch_size, patch_shape = fit_patch_size(img_size, requested_patch_size, max_tokens)
+        if patch_size != requested_patch_size:
+            print(f"patch size {requested_patch_size} coarsened to {patch_size} for {max_tokens} tokens")
+        self.patch_shape = patch_shape
+        self.img_size = img_size
+        self.patch_size = patch_size
+        self.num_patches = math.prod(patch_shape)
+        self.max_tokens = max_tokens
+
+        self.proj = nn.Conv3d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
+
+    def grid_shape(self, input_size):
+        return tuple(i // p for i, p in zip(input_size, self.patch_size))
+
+    def forward(self, x):
+        grid = self.grid_shape(x.shape[-3:])
+        assert self.max_tokens is None or math.prod(grid) <= self.max_tokens, \
+            f"Input volume {tuple(x.shape[-3:])} gives {math.prod(grid)} tokens, over the budget of {self.max_tokens}."
+        x = self.proj(x).flatten(2).transpose(1, 2)
+        return x
+
+
+def fold_patch_embed_depth(state_dict, mean, std, gray_mean, gray_std, key="patch_embed_3d.proj"):
+    """ Fold the depth-3 (RGB channel) patch embedding of a checkpoint into a depth-1 one for grayscale inputs
+    normalized with (gray_mean, gray_std) instead of replicated channels normalized with (mean, std).
+    the per-channel kernels W_d are summed as gray_std * sum_d W_d / std_d, the mean shift moves into the bias.
+    a checkpoint that is already depth-1 is returned as is
+    """
+    weight_key = [k for k in state_dict if k.endswith(f"{key}.weight")]
+    assert len(weight_key) == 1, f"no single {key}.weight in the state dict"
+    weight_key = weight_key[0]
+    bias_key = weight_key[:-len("weight")] + "bias"
+    if state_dict[weight_key].shape[2] == 1:
+        return state_dict
+    weight = state_dict[weight_key].float()
+    assert weight.shape[2] == len(mean) == len(std), "checkpoint is not a depth-3 patch embedding"
+    std = torch.tensor(std).view(1, 1, -1, 1, 1)
+    shift = torch.tensor([gray_mean - m for m in mean]).view(1, 1, -1, 1, 1)
+    folded = gray_std * (weight / std).sum(2, keepdim=True)
+    bias = state_dict[bias_key].float() + (weight * shift / std).sum((1, 2, 3, 4))
+    state_dict[weight_key] = folded.to(state_dict[weight_key].dtype)
+    state_dict[bias_key] = bias.to(state_dict[bias_key].dtype)
+    return state_dict
+
+
+def interpolate_pos_embed_3d(pos_embed, src_shape, dst_shape, num_extra_tokens=1):
+    """ Trilinearly resample the (D, H, W) grid part of a position embedding, extra tokens are kept
+    """
+    if tuple(src_shape) == tuple(dst_shape):
+        return pos_embed
+    extra_tokens = pos_embed[:, :num_extra_tokens]
+    pos_tokens = pos_embed[:, num_extra_tokens:]
+    pos_tokens = pos_tokens.reshape(1, *src_shape, -1).permute(0, 4, 1, 2, 3)
+    pos_tokens = F.interpolate(pos_tokens.float(), size=tuple(dst_shape), mode='trilinear', align_corners=False)
+    pos_tokens = pos_tokens.to(pos_embed.dtype).flatten(2).transpose(1, 2)
+    return torch.cat((extra_tokens, pos_tokens), dim=1)
+
+
+def crop_pos_embed_3d(pos_embed, full_shape, patch_size, coords, grid, num_extra_tokens=1):
+    """ Position embedding of sub-volumes: coords (B, 3) are the voxel starts of each crop in the full volume,
+    the crop of the full (D, H, W) grid under each is gathered, extra tokens are kept
+    """
+    extra_tokens = pos_embed[:, :num_extra_tokens].expand(len(coords), -1, -1)
+    pos_tokens = pos_embed[0, num_extra_tokens:].reshape(*full_shape, -1)
+    patch_size = torch.tensor(patch_size, device=pos_embed.device)
+    coords = coords.to(pos_embed.device).long()
+    assert (coords % patch_size == 0).all(), \
+        f"sub-volume starts off the {tuple(patch_size.tolist())} patch grid, set subvolume_stride to a multiple of it"
+    starts = torch.div(coords, patch_size, rounding_mode='floor')
+    index = [starts[:, axis, None] + torch.arange(grid[axis], device=pos_embed.device) for axis in range(3)]
+    assert all((i[:, -1] < s).all() for i, s in zip(index, full_shape)), "sub-volume outside of the volume grid"
+    pos_tokens = pos_tokens[index[0][:, :, None, None], index[1][:, None, :, None], index[2][:, None, None, :]]
+    return torch.cat((extra_tokens, pos_tokens.flatten(1, 3)), dim=1)
+
+
 class RelativePositionBias(nn.Module):
 
     def __init__(self, window_size, num_heads):
@@ -270,17 +423,33 @@ class VisionTransformer(nn.Module):
                  use_shared_rel_pos_bias=False,
                  use_mean_pooling=True, 
                  init_scale=0.001, 
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 volume_size=None,
+                 volume_patch_size=None,
+                 max_tokens=None,
+                 attn_mode='dense',
+                 attn_window=(4, 4, 4),
+                 in_depth=3):
         super().__init__()
         self.image_size = img_size
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
 
-        self.patch_embed_3d = PatchEmbed(
-            img_size=img_size, 
-            patch_size=patch_size, 
-            in_chans=in_chans, 
-            embed_dim=embed_dim)
+        if volume_size is not None:
+            # full (D, H, W) volumes instead of 3-slice images
+            self.patch_embed_3d = VolumePatchEmbed(
+                img_size=volume_size,
+                patch_size=volume_patch_size,
+                in_chans=in_chans,
+                embed_dim=embed_dim,
+                max_tokens=max_tokens)
+        else:
+            self.patch_embed_3d = PatchEmbed(
+                img_size=img_size, 
+                patch_size=patch_size, 
+                in_chans=in_chans, 
+                embed_dim=embed_dim,
+                in_depth=in_depth)
         num_patches = self.patch_embed_3d.num_patches
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
@@ -302,7 +471,8 @@ class VisionTransformer(nn.Module):
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
-                init_values=init_values, window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None)
+                init_values=init_values, window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None,
+                attn_mode=attn_mode, attn_window=attn_window, attn_axis=i % 3)  # axial blocks cycle D, H, W
             for i in range(depth)])
 
         if self.pos_embed_3d is not None:
@@ -337,26 +507,33 @@ class VisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward_features(self, x):
+    def forward_features(self, x, coords=None):
+        grid = self.patch_embed_3d.patch_shape
+        if isinstance(self.patch_embed_3d, VolumePatchEmbed):
+            grid = self.patch_embed_3d.grid_shape(x.shape[-3:])
         x = self.patch_embed_3d(x)
         batch_size, seq_len, _ = x.size() # torch.Size([16, 4096, 1408])
 
         cls_tokens = self.cls_token.expand(batch_size, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        if self.pos_embed_3d is not None:
-            x = x + self.pos_embed_3d
+        if self.pos_embed_3d is not None and coords is not None:
+            # sub-volumes of a volume_size volume, see ImageTextContrastiveDataset(subvolume_size=...)
+            x = x + crop_pos_embed_3d(
+                self.pos_embed_3d, self.patch_embed_3d.patch_shape, self.patch_embed_3d.patch_size, coords, grid)
+        elif self.pos_embed_3d is not None:
+            x = x + interpolate_pos_embed_3d(self.pos_embed_3d, self.patch_embed_3d.patch_shape, grid)
         x = self.pos_drop(x)
 
         rel_pos_bias = self.rel_pos_bias() if self.rel_pos_bias is not None else None
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x, rel_pos_bias)
+                x = checkpoint.checkpoint(blk, x, rel_pos_bias, grid)
             else:
-                x = blk(x, rel_pos_bias)
+                x = blk(x, rel_pos_bias, grid)
         return x
 
-    def forward(self, x):
-        x = self.forward_features(x)
+    def forward(self, x, coords=None):
+        x = self.forward_features(x, coords)
         return x
 
     def get_intermediate_layers(self, x):
@@ -421,7 +598,9 @@ def convert_weights_to_fp16(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
     
     
-def create_eva_vit_g(img_size=256,patch_size=28,drop_path_rate=0.4,use_checkpoint=False,precision="fp16"):
+def create_eva_vit_g(img_size=256,patch_size=28,drop_path_rate=0.4,use_checkpoint=False,precision="fp16",
+                     volume_size=None,volume_patch_size=(16,16,16),max_tokens=None,
+                     attn_mode='dense',attn_window=(4,4,4),in_depth=3):
     model = VisionTransformer(
         img_size=img_size,
         patch_size=patch_size,
@@ -434,6 +613,12 @@ def create_eva_vit_g(img_size=256,patch_size=28,drop_path_rate=0.4,use_checkpoin
         drop_path_rate=drop_path_rate,
         norm_layer=partial(nn.LayerNorm, eps=1e-6),
         use_checkpoint=use_checkpoint,
+        volume_size=volume_size,
+        volume_patch_size=volume_patch_size,
+        max_tokens=max_tokens,
+        attn_mode=attn_mode,
+        attn_window=attn_window,
+        in_depth=in_depth,
     )  
     url = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/eva_vit_g.pth"
     cached_file = download_cached_file(
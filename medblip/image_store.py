@@ -0,0 +1,65 @@
+import io
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+from PIL import Image
+from torchvision.transforms import Compose, Resize, CenterCrop
+
+
+def image_store_path(data_dir, name, image_size):
+    return f"{data_dir}/pretrain_arrows_umls/{name}_images_{image_size}.npy"
+
+
+def _read_table(data_dir, name):
+    return pa.ipc.RecordBatchFileReader(pa.memory_map(f"{data_dir}/pretrain_arrows_umls/{name}.arrow", "r")).read_all()
+
+
+def _convert_range(args):
+    data_dir, name, path, image_size, start, stop = args
+    table = _read_table(data_dir, name)
+    images = np.load(path, mmap_mode="r+")
+    # same geometry as the Resize/CenterCrop head of clip_transform
+    resize = Compose([Resize(image_size, interpolation=Image.BICUBIC), CenterCrop(image_size)])
+    for i in range(start, stop):
+        image_bytes = io.BytesIO(table["image"][i].as_py())
+        try:
+            images[i] = np.asarray(resize(Image.open(image_bytes).convert("L")))
+        except Exception as e:
+            # left black, quarantine.build_quarantine lists these rows
+            print(f"{name} row {i} not decoded -> {e}")
+    images.flush()
+    return stop - start
+
+
+def build_image_store(data_dir, name, image_size=224, num_workers=8, chunk_size=1024):
+    '''decode every image of a split once and write it as a uint8 [N, H, W] memmap.
+    CXRs are grayscale, so a single channel is kept; clip_transform converts back to RGB.
+    images are stored after Resize + CenterCrop, so train transforms that crop or move the image
+    (clip_resizedcrop, clip_randaug) work on the centre crop instead of the full image.
+    '''
+    num_rows = len(_read_table(data_dir, name))
+    path = image_store_path(data_dir, name, image_size)
+    tmp_path = path + ".tmp"
+    images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(num_rows, image_size, image_size))
+    del images
+
+    jobs = [
+        (data_dir, name, tmp_path, image_size, start, min(start + chunk_size, num_rows))
+        for start in range(0, num_rows, chunk_size)
+    ]
+    done = 0
+    with Pool(num_workers) as pool:
+        for n in pool.imap_unordered(_convert_range, jobs):
+            done += n
+            print(f'{name}: {done}/{num_rows} images converted')
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_image_store(data_dir, name, image_size):
+    path = image_store_path(data_dir, name, image_size)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} not found, build it with run_medblip_preprocess.py first")
+    return np.load(path, mmap_mode="r")
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# bump when the arrays written by build_indices change meaning
+INDEX_CACHE_VERSION = 1
+
+
+def index_cache_key(input_files, **config):
+    '''hash of the dataset config and the (path, size, mtime) of every input file.
+    stat is used instead of the file contents so hashing stays cheap for multi-GB arrow files.
+    '''
+    files = []
+    for path in input_files:
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    payload = json.dumps({"version": INDEX_CACHE_VERSION, "config": config, "files": files}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def index_cache_path(data_dir, key):
+    return f"{data_dir}/pretrain_arrows_umls/index_cache/{key}.npz"
+
+
+def load_index_cache(path):
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def save_index_cache(path, indices):
+    '''best-effort, on a read-only or shared data_dir the indices are rebuilt on every construction.'''
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **indices)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"index cache not written -> {e}")
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,115 @@
+import random
+
+import numpy as np
+
+
+class ChunkIndex:
+    '''constant time row -> (chunk, offset) lookup for chunked arrow columns.
+    columns read from one arrow file share the record batch layout, so one index serves the whole table.
+    '''
+    def __init__(self, chunk_lengths):
+        self.chunk_lengths = tuple(int(length) for length in chunk_lengths)
+        lengths = np.asarray(self.chunk_lengths, dtype=np.int64)
+        self.chunk_starts = np.cumsum(lengths) - lengths
+        self.row_chunks = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+
+    @classmethod
+    def from_column(cls, column):
+        return cls([len(chunk) for chunk in column.iterchunks()])
+
+    def __len__(self):
+        return len(self.row_chunks)
+
+    def locate(self, row):
+        chunk = int(self.row_chunks[row])
+        return chunk, int(row - self.chunk_starts[chunk])
+
+
+class LazyColumn:
+    '''row-wise view over a (memory-mapped) arrow column.
+    values are converted to python on access, so forked dataloader workers
+    share the arrow buffers instead of copying python lists on write.
+    '''
+    def __init__(self, column, chunk_index=None):
+        self.column = column
+        self.chunks = column.chunks
+        if chunk_index is None or chunk_index.chunk_lengths != tuple(len(chunk) for chunk in self.chunks):
+            chunk_index = ChunkIndex.from_column(column)
+        self.chunk_index = chunk_index
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, index):
+        chunk, offset = self.chunk_index.locate(index)
+        return self.chunks[chunk][offset].as_py()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for value in chunk:
+                yield value.as_py()
+
+
+class SampleColumn:
+    '''per-sample view of a per-row LazyColumn, sample index -> value of its table row.'''
+    def __init__(self, column, index_mapper):
+        self.column = column
+        self.rows = index_mapper.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.column[int(self.rows[index])]
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.column[int(row)]
+
+
+class IndexMapper:
+    '''sample index -> (table row, caption index), kept as two int32 arrays instead of a dict of tuples.
+    captions is None when every row is a single sample (image only datasets).
+    '''
+    def __init__(self, rows, captions=None):
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.captions = None if captions is None else np.asarray(captions, dtype=np.int32)
+
+    @classmethod
+    def from_caption_counts(cls, num_captions):
+        num_captions = np.asarray(num_captions, dtype=np.int64)
+        rows = np.repeat(np.arange(len(num_captions), dtype=np.int32), num_captions)
+        first_sample = np.repeat(np.cumsum(num_captions) - num_captions, num_captions)
+        captions = np.arange(len(rows), dtype=np.int64) - first_sample
+        return cls(rows, captions)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if self.captions is None:
+            return int(self.rows[index]), None
+        return int(self.rows[index]), int(self.captions[index])
+
+
+class LabelGroupIndex:
+    '''sample indices grouped by label for negative sampling.
+    order holds the sample indices sorted by label code, the samples of code k are order[starts[k]: starts[k] + counts[k]],
+    so a sample with a different label is drawn in O(1) by skipping that block.
+    '''
+    def __init__(self, codes):
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.order = np.argsort(self.codes, kind="stable").astype(np.int32)
+        self.counts = np.bincount(self.codes).astype(np.int64)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def sample_other(self, index):
+        code = self.codes[index]
+        num_others = len(self.order) - self.counts[code]
+        if num_others == 0:
+            # every sample shares the label, no negative exists
+            return random.randrange(len(self.order))
+        position = random.randrange(num_others)
+        if position >= self.starts[code]:
+            position += self.counts[code]
+        return int(self.order[position])
@@ -0,0 +1,38 @@
+import numpy as np
+import torch
+
+
+class MixtureDataset(torch.utils.data.ConcatDataset):
+    '''several sources behind one index space, each keeping its own memory-mapped table.
+    unlike BaseDataset(names=[...]) nothing is concatenated, so adding a source does not rebuild a table.
+    sample it with WeightedSourceSampler to mix the sources by ratio.
+    '''
+    def __init__(self, datasets):
+        super().__init__(datasets)
+        self.collate = self.datasets[0].collate
+
+    @property
+    def source_sizes(self):
+        return [len(dataset) for dataset in self.datasets]
+
+
+class WeightedSourceSampler(torch.utils.data.Sampler):
+    '''draws a source for every sample with probability proportional to weights, then a uniform index inside it.
+    reweighting only needs a new sampler, the datasets are untouched.
+    '''
+    def __init__(self, dataset, weights, num_samples=None, generator=None):
+        assert len(weights) == len(dataset.datasets)
+        self.sizes = torch.as_tensor(dataset.source_sizes, dtype=torch.long)
+        self.offsets = torch.as_tensor(np.cumsum([0] + dataset.source_sizes[:-1]), dtype=torch.long)
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        assert (self.weights[self.sizes == 0] == 0).all(), "empty sources need a zero weight"
+        self.num_samples = len(dataset) if num_samples is None else num_samples
+        self.generator = generator
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        sources = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=self.generator)
+        within = (torch.rand(self.num_samples, generator=self.generator, dtype=torch.double) * self.sizes[sources]).long()
+        yield from (self.offsets[sources] + within).tolist()
@@ -37,11 +37,19 @@ class MedBLIPModel_biomedlm(Blip2Base):
         max_txt_len=100,
         apply_lemmatizer=False,
         embed_dim=256,
+        vit_volume_size=None,
+        vit_volume_patch_size=(16, 16, 16),
+        vit_max_tokens=None,
+        vit_attn_mode="dense",
+        vit_attn_window=(4, 4, 4),
+        vit_in_depth=3,
     ):
         super().__init__()
 
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, patch_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, patch_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            vit_volume_size, vit_volume_patch_size, vit_max_tokens, vit_attn_mode, vit_attn_window,
+            vit_in_depth
         )
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -81,14 +89,26 @@ class MedBLIPModel_biomedlm(Blip2Base):
         patch_size,
         drop_path_rate, 
         use_grad_checkpoint, 
-        precision
+        precision,
+        volume_size=None,
+        volume_patch_size=(16, 16, 16),
+        max_tokens=None,
+        attn_mode="dense",
+        attn_window=(4, 4, 4),
+        in_depth=3,
     ):
         visual_encoder = create_eva_vit_g(
                 img_size,
                 patch_size, 
                 drop_path_rate, 
                 use_grad_checkpoint, 
-                precision
+                precision,
+                volume_size,
+                volume_patch_size,
+                max_tokens,
+                attn_mode,
+                attn_window,
+                in_depth,
             )
         
         ln_vision = LayerNorm(visual_encoder.num_features)
@@ -128,7 +148,7 @@ class MedBLIPModel_biomedlm(Blip2Base):
                 tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
 
         with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.ln_vision(self.visual_encoder(image, samples.get("coords")))
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
         query_output = self.Qformer.bert(
@@ -279,7 +299,7 @@ class MedBLIPModel_biomedlm(Blip2Base):
         
         image = samples["images"]
         with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.ln_vision(self.visual_encoder(image, samples.get("coords")))
         image_embeds = image_embeds.float()
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
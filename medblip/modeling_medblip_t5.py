@@ -35,12 +35,20 @@ class MedBLIPModel_t5(Blip2Base):
         t5_model="google/flan-t5-xl",
         max_txt_len=60,
         embed_dim=256,
+        vit_volume_size=None,
+        vit_volume_patch_size=(16, 16, 16),
+        vit_max_tokens=None,
+        vit_attn_mode="dense",
+        vit_attn_window=(4, 4, 4),
+        vit_in_depth=3,
     ):
         super().__init__()
 
         self.tokenizer = self.init_tokenizer()
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, patch_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, patch_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            vit_volume_size, vit_volume_patch_size, vit_max_tokens, vit_attn_mode, vit_attn_window,
+            vit_in_depth
         )
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -85,14 +93,26 @@ class MedBLIPModel_t5(Blip2Base):
         patch_size,
         drop_path_rate, 
         use_grad_checkpoint, 
-        precision
+        precision,
+        volume_size=None,
+        volume_patch_size=(16, 16, 16),
+        max_tokens=None,
+        attn_mode="dense",
+        attn_window=(4, 4, 4),
+        in_depth=3,
     ):
         visual_encoder = create_eva_vit_g(
                 img_size,
                 patch_size, 
                 drop_path_rate, 
                 use_grad_checkpoint, 
-                precision
+                precision,
+                volume_size,
+                volume_patch_size,
+                max_tokens,
+                attn_mode,
+                attn_window,
+                in_depth,
             )
         
         ln_vision = LayerNorm(visual_encoder.num_features)
@@ -132,7 +152,7 @@ class MedBLIPModel_t5(Blip2Base):
                 tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
 
         with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
+            image_embeds = self.ln_vision(self.visual_encoder(image, samples.get("coords")))
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
         query_output = self.Qformer.bert(
@@ -286,7 +306,7 @@ class MedBLIPModel_t5(Blip2Base):
         if 'images' in samples.keys():
             image = samples["images"]
             with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+                image_embeds = self.ln_vision(self.visual_encoder(image, samples.get("coords")))
             image_embeds = image_embeds.float()
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class VolumePrefetcher:
+    '''reads upcoming samples on a thread pool ahead of __getitem__.
+    indices are queued with schedule(), at most depth reads are in flight, get() waits for a
+    scheduled read or reads synchronously when the index was not scheduled (a miss).
+    a read not collected within expire get() calls (2 * depth by default, e.g. the tail of an interrupted
+    epoch) is dropped, so depth should cover two batches.
+    the pool is created lazily per process, so a prefetcher built before the DataLoader forks still works,
+    and it is left out when pickled for spawned workers.
+    '''
+    def __init__(self, read_fn, depth=16, num_threads=4, expire=None):
+        self.read_fn = read_fn
+        self.depth = depth
+        self.num_threads = num_threads
+        self.expire = 2 * depth if expire is None else expire
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['pool', 'lock', 'pending', 'in_flight', 'scheduled']:
+            state.pop(key, None)
+        state['pid'] = None
+        return state
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.pool = ThreadPoolExecutor(self.num_threads)
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.in_flight = dict()
+        # get() count at which every pending / in flight index was scheduled
+        self.scheduled = dict()
+        self.hits, self.misses, self.wait_time, self.gets = 0, 0, 0., 0
+
+    def _fill(self):
+        while self.pending and len(self.in_flight) < self.depth:
+            index = self.pending.popleft()
+            self.in_flight[index] = self.pool.submit(self.read_fn, index)
+
+    def _drop(self, index):
+        future = self.in_flight.pop(index, None)
+        if future is not None:
+            future.cancel()
+        elif index in self.pending:
+            self.pending.remove(index)
+        self.scheduled.pop(index, None)
+
+    def _expire(self):
+        for index in [i for i, stamp in self.scheduled.items() if self.gets - stamp > self.expire]:
+            self._drop(index)
+
+    def schedule(self, indices):
+        self._start()
+        with self.lock:
+            # an index already queued is not queued twice, a repeat further ahead is read as a miss
+            for index in indices:
+                if index not in self.scheduled:
+                    self.pending.append(index)
+                    self.scheduled[index] = self.gets
+            self._fill()
+
+    def get(self, index):
+        self._start()
+        with self.lock:
+            self.gets += 1
+            future = self.in_flight.pop(index, None)
+            if future is None and index in self.pending:
+                # not started yet, read it here instead of leaving a read nobody collects
+                self.pending.remove(index)
+            self.scheduled.pop(index, None)
+            self._expire()
+            self._fill()
+        if future is None:
+            self.misses += 1
+            return self.read_fn(index)
+        self.hits += 1
+        start = time.time()
+        result = future.result()
+        self.wait_time += time.time() - start
+        return result
+
+    def clear(self):
+        '''drops every scheduled read, e.g. at the end of an epoch.'''
+        self._start()
+        with self.lock:
+            for index in list(self.scheduled):
+                self._drop(index)
+
+    def stats(self):
+        '''queue depth metrics of this process, queue_depth near depth with little wait_time means reads keep up.'''
+        self._start()
+        return {
+            'queue_depth': len(self.in_flight),
+            'pending': len(self.pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'wait_time': self.wait_time,
+        }
+
+
+class PrefetchSampler(torch.utils.data.Sampler):
+    '''wraps a sampler and schedules the next depth indices on dataset.prefetcher as it is iterated.
+    the sampler runs in the main process, so this only helps with num_workers=0, where the thread pool
+    replaces worker processes. with worker processes use PrefetchBatchSampler.
+    '''
+    def __init__(self, sampler, dataset):
+        self.sampler = sampler
+        self.prefetcher = dataset.prefetcher
+        assert self.prefetcher is not None, "build the dataset with prefetch_threads > 0"
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        upcoming = deque()
+        iterator = iter(self.sampler)
+        for index in iterator:
+            upcoming.append(index)
+            if len(upcoming) > self.prefetcher.depth:
+                break
+        self.prefetcher.schedule(upcoming)
+        try:
+            while upcoming:
+                yield upcoming.popleft()
+                for index in iterator:
+                    upcoming.append(index)
+                    self.prefetcher.schedule([index])
+                    break
+        finally:
+            # reads left over by an interrupted epoch
+            self.prefetcher.clear()
+
+
+class PrefetchBatch(list):
+    '''indices of a batch, with the indices of the batch the same DataLoader worker receives next.'''
+    upcoming = []
+
+
+class PrefetchBatchSampler(torch.utils.data.Sampler):
+    '''wraps a batch sampler for DataLoader(batch_sampler=..., num_workers=num_workers). the DataLoader hands
+    batches to its workers round-robin, so every batch carries the batch num_workers further on, which
+    __getitems__ schedules on the worker's prefetcher while the current one is being read.
+    '''
+    def __init__(self, batch_sampler, num_workers=0):
+        self.batch_sampler = batch_sampler
+        self.ahead = max(num_workers, 1)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        batches = deque()
+        for indices in self.batch_sampler:
+            batches.append(PrefetchBatch(indices))
+            if len(batches) > self.ahead:
+                batches[0].upcoming = list(batches[-1])
+                yield batches.popleft()
+        yield from batches
@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+
+from .lazy_table import ChunkIndex, LazyColumn
+
+ENCODING_COLUMNS = {
+    "input_ids": pa.list_(pa.int32()),
+    "attention_mask": pa.list_(pa.int8()),
+    "special_tokens_mask": pa.list_(pa.int8()),
+    "ent_ref": pa.list_(pa.bool_()),
+    "txt_label": pa.list_(pa.int32()),
+    "ent_spans": pa.list_(pa.list_(pa.int32())),
+}
+# un-prefixed columns encode the caption with its diagnosis suffix (get_text),
+# caption_ columns the bare caption (get_false_text)
+PREFIXES = {True: "", False: "caption_"}
+# rows are keyed by (row of the split's arrow table, caption index), not by index_mapper position,
+# so a file fits datasets built with and without quarantine
+KEY_COLUMNS = {
+    "row": pa.int32(),
+    "caption": pa.int32(),
+}
+SCHEMA = pa.schema([pa.field(column, column_type) for column, column_type in KEY_COLUMNS.items()] + [
+    pa.field(prefix + column, column_type)
+    for prefix in PREFIXES.values()
+    for column, column_type in ENCODING_COLUMNS.items()
+])
+
+
+def pretokenized_path(data_dir, name, max_text_len):
+    return f"{data_dir}/pretrain_arrows_umls/{name}_tokens_{max_text_len}.arrow"
+
+
+def build_pretokenized(dataset, batch_size=4096):
+    '''tokenize every sample of dataset once and write one arrow row per sample for each split.
+    dataset must be built with pretokenized=False. samples that fail to tokenize are left out,
+    PretokenizedText.get returns None for them and BaseDataset tokenizes them on the fly.
+    '''
+    rows = dataset.index_mapper.rows
+    captions = dataset.index_mapper.captions
+    for name, start_row, stop_row in zip(dataset.names, dataset.table_offsets[:-1], dataset.table_offsets[1:]):
+        first, last = np.searchsorted(rows, [start_row, stop_row])
+        path = pretokenized_path(dataset.data_dir, name, dataset.max_text_len)
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.RecordBatchFileWriter(sink, SCHEMA) as writer:
+                for begin in range(first, last, batch_size):
+                    columns = {field.name: [] for field in SCHEMA}
+                    for raw_index in range(begin, min(begin + batch_size, last)):
+                        try:
+                            encodings = dict()
+                            for with_labels, prefix in PREFIXES.items():
+                                text = dataset.get_caption(raw_index, with_labels=with_labels)
+                                encodings[prefix] = dataset.encode_text(raw_index, text, with_labels=with_labels)
+                        except Exception as e:
+                            print(f"{name} sample {raw_index} not pre-tokenized -> {e}")
+                            continue
+                        columns["row"].append(int(rows[raw_index]) - int(start_row))
+                        columns["caption"].append(0 if captions is None else int(captions[raw_index]))
+                        for prefix, encoding in encodings.items():
+                            for column in ENCODING_COLUMNS:
+                                columns[prefix + column].append(encoding[column])
+                    writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=SCHEMA))
+                    print(f'{name}: {min(begin + batch_size, last) - first}/{last - first} texts tokenized')
+        os.replace(tmp_path, path)
+
+
+class PretokenizedText:
+    '''memory-mapped encodings written by build_pretokenized, looked up by the (table row, caption index)
+    of every sample of index_mapper. samples without a stored row get None.
+    '''
+    def __init__(self, data_dir, names, max_text_len, index_mapper, table_offsets):
+        tables = list()
+        for name in names:
+            path = pretokenized_path(data_dir, name, max_text_len)
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"{path} not found, build it with run_medblip_preprocess.py first")
+            table = pa.ipc.RecordBatchFileReader(pa.memory_map(path, "r")).read_all()
+            if "row" not in table.column_names:
+                raise ValueError(f"{path} has no (row, caption) keys, rebuild it with run_medblip_preprocess.py")
+            tables.append(table)
+        self.table = pa.concat_tables(tables)
+        chunk_index = ChunkIndex.from_column(self.table.column(0))
+        self.columns = {column: LazyColumn(self.table[column], chunk_index) for column in self.table.column_names}
+
+        # (global row, caption) of every stored encoding, matched against the samples of index_mapper
+        counts = [len(table) for table in tables]
+        stored_rows = self.table["row"].to_numpy().astype(np.int64) + np.repeat(table_offsets[:-1], counts)
+        stored_keys = (stored_rows << 32) | self.table["caption"].to_numpy().astype(np.int64)
+        captions = np.zeros(len(index_mapper), dtype=np.int64) if index_mapper.captions is None else index_mapper.captions
+        sample_keys = (index_mapper.rows.astype(np.int64) << 32) | captions.astype(np.int64)
+        order = np.argsort(stored_keys, kind="stable")
+        found = np.searchsorted(stored_keys, sample_keys, sorter=order)
+        found = np.minimum(found, max(len(order) - 1, 0))
+        self.positions = np.full(len(index_mapper), -1, dtype=np.int64)
+        if len(order):
+            match = stored_keys[order[found]] == sample_keys
+            self.positions[match] = order[found[match]]
+        self.num_missing = int((self.positions < 0).sum())
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, index, with_labels=True):
+        position = int(self.positions[index])
+        if position < 0:
+            return None
+        prefix = PREFIXES[with_labels]
+        return {column: self.columns[prefix + column][position] for column in ENCODING_COLUMNS}
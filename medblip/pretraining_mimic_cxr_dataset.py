@@ -1,9 +1,10 @@
 import os
-import random
 from collections import defaultdict
 
+import numpy as np
+
 from .base_dataset import BaseDataset
-from .utils import record_ent_ref
+from .lazy_table import LabelGroupIndex, LazyColumn, SampleColumn
 
 
 class MIMICCXRDataset(BaseDataset):
@@ -20,42 +21,36 @@ class MIMICCXRDataset(BaseDataset):
         else:
             raise ValueError
 
+        # collate below only keeps the images and the captions
+        kwargs.setdefault("collate_keys", {"image"} if kwargs.get("image_only") else {"image", "text"})
         super().__init__(*args, **kwargs, names=names, text_column_name="caption")
-        self.chexpert_labels = self.table["chexpert"].to_pandas().tolist()
-        dup_indices = [self.index_mapper[i][0] for i in self.index_mapper]
-        self.chexpert_labels = [self.chexpert_labels[idx] for idx in dup_indices]
-        self.group_mappings = defaultdict(set)
-        for idx, label in enumerate(self.chexpert_labels):
-            self.group_mappings[str(label)].add(idx)
-        full_index_set = set(list(range(len(self.chexpert_labels))))
-        for k in self.group_mappings:
-            self.group_mappings[k] = full_index_set - self.group_mappings[k]
+        # indexed by sample like before, duplicated over the captions of a row
+        self.chexpert_labels = SampleColumn(LazyColumn(self.table["chexpert"], self.chunk_index), self.index_mapper)
+
+    def build_indices(self, tables):
+        indices = super().build_indices(tables)
+        label_codes = dict()
+        row_codes = np.array([
+            label_codes.setdefault(str(label), len(label_codes))
+            for label in LazyColumn(self.table["chexpert"], self.chunk_index)
+        ], dtype=np.int32)
+        indices["chexpert_codes"] = row_codes[indices["index_rows"]]
+        return indices
+
+    def set_indices(self, indices):
+        super().set_indices(indices)
+        self.group_index = LabelGroupIndex(indices["chexpert_codes"])
 
     def get_false_image(self, rep, image_key="image", selected_index=None):
-        chexpert_label = str(self.chexpert_labels[selected_index])
-        candidate_index = self.group_mappings[chexpert_label]
-
-        random_index = random.sample(candidate_index, 1)[0]
+        random_index = self.group_index.sample_other(selected_index)
         image = self.get_raw_image(random_index, image_key=image_key)
         image_tensor = [tr(image) for tr in self.transforms]
         return {f"false_image_{rep}": image_tensor}
 
     def get_false_text(self, rep, selected_index=None):
-        chexpert_label = str(self.chexpert_labels[selected_index])
-        candidate_index = self.group_mappings[chexpert_label]
-
-        random_index = random.sample(candidate_index, 1)[0]
-        index, caption_index = self.index_mapper[random_index]
-        text = self.all_texts[index][caption_index]
-        encoding = self.tokenizer(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=self.max_text_len,
-            return_special_tokens_mask=True,
-            return_offsets_mapping=True,
-        )
-        encoding = record_ent_ref(encoding, self.all_txt_ents[index][caption_index])
+        random_index = self.group_index.sample_other(selected_index)
+        text = self.get_caption(random_index, with_labels=False)
+        encoding = self.encode_text(random_index, text, with_labels=False)
         return {f"false_text_{rep}": (text, encoding)}
 
     def __getitem__(self, index):
@@ -82,7 +77,8 @@ class MIMICCXRDataset(BaseDataset):
                         print(f'\t {k}, {vvidx}: {vv}')
                 if k == 'image':
                         print(f'\t {k}, {v[0].shape}')
-            print(fr'labels, {dict_batch["txt_labels"][0]}')
+            if "txt_labels" in dict_batch:
+                print(fr'labels, {dict_batch["txt_labels"][0]}')
             print('<-' * 10 + 'batch contents' + '<-' * 10)
 
         inputs = defaultdict(list)
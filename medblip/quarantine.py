@@ -0,0 +1,83 @@
+import io
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+from PIL import Image
+
+from .utils import record_ent_ref
+
+
+def quarantine_path(data_dir, name):
+    return f"{data_dir}/pretrain_arrows_umls/{name}_quarantine.npy"
+
+
+# tokenizer and table of a pool worker, loaded once by _init_worker instead of per job
+_tokenizer = None
+_table = None
+
+
+def _init_worker(data_dir, name, tokenizer_name):
+    global _tokenizer, _table
+    # imported here so the pool workers load the tokenizer themselves
+    from .base_dataset import get_pretrained_tokenizer
+    _tokenizer = get_pretrained_tokenizer(tokenizer_name)
+    _table = pa.ipc.RecordBatchFileReader(pa.memory_map(f"{data_dir}/pretrain_arrows_umls/{name}.arrow", "r")).read_all()
+
+
+def _validate_range(args):
+    name, max_text_len, start, stop = args
+    bad_rows = list()
+    failures = Counter()
+    for row in range(start, stop):
+        try:
+            Image.open(io.BytesIO(_table["image"][row].as_py())).convert("RGB")
+            captions = _table["caption"][row].as_py()
+            txt_ents = _table["txt_ents"][row].as_py()
+            assert len(captions) > 0, "no caption"
+            assert len(txt_ents) == len(captions), "caption / entity count mismatch"
+            for caption, ents in zip(captions, txt_ents):
+                encoding = _tokenizer(
+                    caption,
+                    padding="max_length",
+                    truncation=True,
+                    max_length=max_text_len,
+                    return_special_tokens_mask=True,
+                    return_offsets_mapping=True,
+                )
+                record_ent_ref(encoding, ents)
+        except Exception as e:
+            print(f"{name} row {row} quarantined -> {e}")
+            bad_rows.append(row)
+            failures[type(e).__name__] += 1
+    return bad_rows, failures
+
+
+def build_quarantine(data_dir, name, tokenizer="bert-base-uncased", max_text_len=40, num_workers=8, chunk_size=1024):
+    '''decode every image and tokenize every caption of a split once, in a process pool,
+    and save the rows that fail. BaseDataset(quarantine=True) drops their samples up front.
+    '''
+    num_rows = len(pa.ipc.RecordBatchFileReader(pa.memory_map(f"{data_dir}/pretrain_arrows_umls/{name}.arrow", "r")).read_all())
+    jobs = [
+        (name, max_text_len, start, min(start + chunk_size, num_rows))
+        for start in range(0, num_rows, chunk_size)
+    ]
+    bad_rows = list()
+    failures = Counter()
+    with Pool(num_workers, initializer=_init_worker, initargs=(data_dir, name, tokenizer)) as pool:
+        for rows, counts in pool.imap_unordered(_validate_range, jobs):
+            bad_rows += rows
+            failures += counts
+    bad_rows = np.array(sorted(bad_rows), dtype=np.int64)
+    np.save(quarantine_path(data_dir, name), bad_rows)
+    print(f'{name}: {len(bad_rows)}/{num_rows} rows quarantined', dict(failures))
+    return bad_rows
+
+
+def load_quarantine(data_dir, name):
+    path = quarantine_path(data_dir, name)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} not found, build it with run_medblip_preprocess.py first")
+    return np.load(path)
@@ -0,0 +1,94 @@
+import random
+
+import numpy as np
+import torch
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    '''sequential variant of a BaseDataset (e.g. MIMICCXRDataset) for corpora larger than the page cache.
+    the arrow record batches are cut into blocks of at most block_size rows (a file written with write_table
+    often holds a single record batch), blocks are split over ranks then dataloader workers so none is read
+    twice, and the image bytes of a whole block are read in one sequential slice. samples are shuffled in a
+    bounded buffer of fetched (index, image bytes) pairs and decoded when emitted.
+    every rank streams the same number of samples, the remainder is dropped.
+    '''
+    def __init__(self, dataset, shuffle=True, shuffle_buffer_size=1024, block_size=1024, seed=0):
+        super().__init__()
+        assert dataset.draw_false_image == 0 and dataset.draw_false_text == 0, \
+            "false image / text sampling needs random access, use the map-style dataset"
+        self.dataset = dataset
+        self.collate = dataset.collate
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+
+        # [row_start, row_stop) of every block, record batch boundaries are kept
+        chunk_index = dataset.chunk_index
+        chunk_stops = np.append(chunk_index.chunk_starts[1:], len(chunk_index))
+        self.block_rows = np.array([
+            (start, min(start + block_size, stop))
+            for chunk_start, stop in zip(chunk_index.chunk_starts, chunk_stops)
+            for start in range(chunk_start, stop, block_size)
+        ], dtype=np.int64).reshape(-1, 2)
+        # sample range of every block, index_mapper is sorted by table row
+        self.block_samples = np.searchsorted(dataset.index_mapper.rows, self.block_rows)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank_blocks(self):
+        '''blocks of this rank and how many of their samples it streams.'''
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        blocks = np.arange(len(self.block_rows))
+        if self.shuffle:
+            # same permutation on every rank so the shards stay disjoint
+            np.random.default_rng(self.seed + self.epoch).shuffle(blocks)
+        lengths = self.block_samples[blocks, 1] - self.block_samples[blocks, 0]
+        quota = min(lengths[r::world_size].sum() for r in range(world_size))
+        return blocks[rank::world_size], quota
+
+    def __len__(self):
+        return int(self._rank_blocks()[1])
+
+    def _read_block(self, block, num_samples):
+        '''(sample index, image bytes) of the first num_samples samples of a block, one sequential read.'''
+        row_start, row_stop = self.block_rows[block]
+        sample_start, sample_stop = self.block_samples[block]
+        sample_stop = min(sample_stop, sample_start + num_samples)
+        images = [None] * (row_stop - row_start)
+        if self.dataset.image_store is None:
+            images = self.dataset.table["image"].slice(row_start, row_stop - row_start).to_pylist()
+        rows = self.dataset.index_mapper.rows[sample_start:sample_stop]
+        return [(index, images[row - row_start]) for index, row in zip(range(sample_start, sample_stop), rows.tolist())]
+
+    def __iter__(self):
+        blocks, quota = self._rank_blocks()
+        # blocks of this rank are cut at quota samples, then dealt to the workers
+        lengths = self.block_samples[blocks, 1] - self.block_samples[blocks, 0]
+        takes = np.clip(quota - (np.cumsum(lengths) - lengths), 0, lengths)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            blocks = blocks[worker_info.id::worker_info.num_workers]
+            takes = takes[worker_info.id::worker_info.num_workers]
+        rng = random.Random(hash((self.seed, self.epoch, tuple(blocks[:1].tolist()))))
+
+        buffer = list()
+        for block, take in zip(blocks.tolist(), takes.tolist()):
+            if take == 0:
+                continue
+            for index, image_bytes in self._read_block(block, take):
+                if not self.shuffle:
+                    yield self.dataset.get_suite(index, image_bytes)
+                elif len(buffer) < self.shuffle_buffer_size:
+                    buffer.append((index, image_bytes))
+                else:
+                    position = rng.randrange(self.shuffle_buffer_size)
+                    yield self.dataset.get_suite(*buffer[position])
+                    buffer[position] = (index, image_bytes)
+        rng.shuffle(buffer)
+        for index, image_bytes in buffer:
+            yield self.dataset.get_suite(index, image_bytes)
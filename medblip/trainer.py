@@ -60,11 +60,17 @@ class Trainer:
 
         skip_scheduler = False
         for epoch in range(start_epoch, epochs):
+            if hasattr(dataloader.dataset, 'set_epoch'):
+                dataloader.dataset.set_epoch(epoch)
             data_iterator = iter(dataloader)
             for train_iter in range(steps_per_epoch):
                 model.zero_grad()
                 model.train()              
-                data = next(data_iterator)
+                try:
+                    data = next(data_iterator)
+                except StopIteration:
+                    # iterable datasets may yield fewer batches than len(dataloader) estimates
+                    break
 
                 if use_amp:
                     with autocast():
@@ -92,7 +98,7 @@ class Trainer:
                 if not skip_scheduler:
                     scheduler.step()
 
-                if train_iter == (steps_per_epoch-1) and 't5' in output_path:
+                if train_iter == (1) and 'biomedlm' in output_path:
                     eval_data_iterator = iter(eval_dataloader)
                     num_iter = len(eval_dataloader)
                     for eval_iter in range(num_iter):           
@@ -140,53 +146,54 @@ class Trainer:
                                 print('eval_iter[{}/{}][{}/{}] answer: '.format(eval_iter,num_iter,i,bs), res[i])
                                 print('-----------------------------------------------')
 
-                if train_iter == (1) and 'biomedlm' in output_path:
-                    eval_data_iterator = iter(eval_dataloader)
-                    num_iter = len(eval_dataloader)
-                    for eval_iter in range(num_iter):           
-                        eval_data = next(eval_data_iterator)
-                        images = eval_data['images'].cuda().half()
-                        text = []
-                        question = []
-                        answer = []
-                        tq = []
-                        bs = len(eval_data['reports'])
-                        for b in range(bs):
-                            doc = eval_data['reports'][b] 
-                            if 'The diagnosis is' in doc:
-                                text.append(doc.split('The diagnosis is ')[0])
-                                question.append('What will this subject be diagnosed with?') # hard coded
-                                label = doc.split('The diagnosis is ')[1].split('.')[0]
-                                # label = label.replace('AD','Dementia')
-                                # label = label.replace('Demented','Dementia')
-                                # label = label.replace('NC','Not demented')
-                                # label = label.replace('CN','Not demented')
-                                # label = label.replace('Nondemented','Not demented')
-                                # label = label.replace('control','Not demented')
-                                # label = label.replace('MCI','mild cognitive impairment (MCI)')
-                                answer.append(label)
-                                tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
-
-                            else:
-                                text.append(doc)
-                                question.append('What will this subject be diagnosed with?') # hard coded
-                                answer.append('')
-                                tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
-                        model.eval()
+            # end of epoch eval, also reached when the dataloader runs out before steps_per_epoch
+            if 't5' in output_path:
+                eval_data_iterator = iter(eval_dataloader)
+                num_iter = len(eval_dataloader)
+                for eval_iter in range(num_iter):           
+                    eval_data = next(eval_data_iterator)
+                    images = eval_data['images'].cuda().half()
+                    text = []
+                    question = []
+                    answer = []
+                    tq = []
+                    bs = len(eval_data['reports'])
+                    for b in range(bs):
+                        doc = eval_data['reports'][b] 
+                        if 'The diagnosis is' in doc:
+                            text.append(doc.split('The diagnosis is ')[0])
+                            question.append('What will this subject be diagnosed with?') # hard coded
+                            label = doc.split('The diagnosis is ')[1].split('.')[0]
+                            # label = label.replace('AD','Dementia')
+                            # label = label.replace('Demented','Dementia')
+                            # label = label.replace('NC','Not demented')
+                            # label = label.replace('CN','Not demented')
+                            # label = label.replace('Nondemented','Not demented')
+                            # label = label.replace('control','Not demented')
+                            # label = label.replace('MCI','mild cognitive impairment (MCI)')
+                            answer.append(label)
+                            tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
 
-                        if isinstance(model, torch.nn.DataParallel):
-                            res = model.module.generate({"images": images, 'prompt': tq}) # "images": images,
                         else:
-                            res = model.generate({"images": images, 'prompt': tq}) # "images": images,
-
-                        if eval_iter % 100 == 0:
-                            for i in range(bs):
-                                print('-----------------------------------------------')
-                                print('eval_iter[{}/{}][{}/{}] report: '.format(eval_iter,num_iter,i,bs), eval_data['reports'][i])
-                                print('eval_iter[{}/{}][{}/{}] prompt: '.format(eval_iter,num_iter,i,bs), tq[i])
-                                print('eval_iter[{}/{}][{}/{}] gt_answer: '.format(eval_iter,num_iter,i,bs), answer[i])
-                                print('eval_iter[{}/{}][{}/{}] answer: '.format(eval_iter,num_iter,i,bs), res[i])
-                                print('-----------------------------------------------')
+                            text.append(doc)
+                            question.append('What will this subject be diagnosed with?') # hard coded
+                            answer.append('')
+                            tq.append(doc.split('The diagnosis is ')[0] + 'Question: What will this subject be diagnosed with? Answer: ')
+                    model.eval()
+
+                    if isinstance(model, torch.nn.DataParallel):
+                        res = model.module.generate({"images": images, 'prompt': tq}) # "images": images,
+                    else:
+                        res = model.generate({"images": images, 'prompt': tq}) # "images": images,
+
+                    if eval_iter % 100 == 0:
+                        for i in range(bs):
+                            print('-----------------------------------------------')
+                            print('eval_iter[{}/{}][{}/{}] report: '.format(eval_iter,num_iter,i,bs), eval_data['reports'][i])
+                            print('eval_iter[{}/{}][{}/{}] prompt: '.format(eval_iter,num_iter,i,bs), tq[i])
+                            print('eval_iter[{}/{}][{}/{}] gt_answer: '.format(eval_iter,num_iter,i,bs), answer[i])
+                            print('eval_iter[{}/{}][{}/{}] answer: '.format(eval_iter,num_iter,i,bs), res[i])
+                            print('-----------------------------------------------')
 
             self._save_ckpt(model,epoch,output_path)
 
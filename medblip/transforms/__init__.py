@@ -1,13 +1,24 @@
+from functools import partial
+
 from .transform import (
     clip_transform,
     clip_transform_randaug,
-    clip_transform_resizedcrop
+    clip_transform_resizedcrop,
+    clip_gray_transform,
+    clip_gray_transform_resizedcrop,
+    clip_gray_transform_randaug,
 )
 
 _transforms = {
     "clip": clip_transform,
     "clip_randaug": clip_transform_randaug,
-    "clip_resizedcrop": clip_transform_resizedcrop
+    # photometric RandAugment ops fused into one lookup table pass
+    "clip_randaug_lut": partial(clip_transform_randaug, fuse_lut=True),
+    "clip_resizedcrop": clip_transform_resizedcrop,
+    "clip_gray": clip_gray_transform,
+    "clip_gray_resizedcrop": clip_gray_transform_resizedcrop,
+    "clip_gray_randaug": clip_gray_transform_randaug,
+    "clip_gray_randaug_lut": partial(clip_gray_transform_randaug, fuse_lut=True),
 }
 
 
@@ -84,7 +84,7 @@ def Solarize(img, v):  # [0, 256]
 
 
 def SolarizeAdd(img, addition=0, threshold=128):
-    img_np = np.array(img).astype(np.int)
+    img_np = np.array(img).astype(np.int64)
     img_np = img_np + addition
     img_np = np.clip(img_np, 0, 255)
     img_np = img_np.astype(np.uint8)
@@ -206,6 +206,105 @@ def augment_list():  # 16 oeprations and their ranges
     return l
 
 
+def _blend_lut(degenerate, factor):
+    # Image.blend(degenerate, img, factor) per intensity, float32 and truncated like PIL
+    lut = np.float32(degenerate) + np.float32(factor) * (np.arange(256, dtype=np.float32) - np.float32(degenerate))
+    return np.clip(lut, 0, 255).astype(np.int64)
+
+
+def AutoContrastLUT(hist, _):
+    lut = np.tile(np.arange(256), (len(hist), 1))
+    for c, h in enumerate(hist):
+        support = np.flatnonzero(h)
+        if len(support) and support[-1] > support[0]:
+            scale = 255.0 / (support[-1] - support[0])
+            offset = -support[0] * scale
+            lut[c] = np.clip((np.arange(256) * scale + offset).astype(np.int64), 0, 255)
+    return lut
+
+
+def EqualizeLUT(hist, _):
+    lut = np.tile(np.arange(256), (len(hist), 1))
+    for c, h in enumerate(hist):
+        histo = h[h > 0]
+        if len(histo) <= 1:
+            continue
+        step = (histo.sum() - histo[-1]) // 255
+        if step:
+            lut[c] = np.minimum((step // 2 + np.cumsum(h) - h) // step, 255)
+    return lut
+
+
+def SolarizeLUT(hist, v):
+    lut = np.arange(256)
+    return np.tile(np.where(lut < v, lut, 255 - lut), (len(hist), 1))
+
+
+def SolarizeAddLUT(hist, addition=0, threshold=128):
+    lut = np.clip(np.arange(256) + addition, 0, 255).astype(np.int64)
+    return np.tile(np.where(lut < threshold, lut, 255 - lut), (len(hist), 1))
+
+
+def PosterizeLUT(hist, v):
+    mask = ~(2 ** (8 - max(1, int(v))) - 1)
+    return np.tile(np.arange(256) & mask, (len(hist), 1))
+
+
+def ContrastLUT(hist, v):
+    # mean of the image converted to L, from the band means for RGB (PIL rounds L per pixel, this may be off by one)
+    means = (hist * np.arange(256)).sum(1) / hist.sum(1)
+    mean = means[0] if len(hist) == 1 else np.dot(means, [0.299, 0.587, 0.114])
+    return np.tile(_blend_lut(int(mean + 0.5), v), (len(hist), 1))
+
+
+def BrightnessLUT(hist, v):
+    return np.tile(_blend_lut(0, v), (len(hist), 1))
+
+
+def IdentityLUT(hist, _):
+    return np.tile(np.arange(256), (len(hist), 1))
+
+
+# photometric ops as 256-entry lookup tables built from the histogram of the image they are applied to
+lut_ops = {
+    AutoContrast: AutoContrastLUT,
+    Equalize: EqualizeLUT,
+    Solarize: SolarizeLUT,
+    SolarizeAdd: SolarizeAddLUT,
+    Posterize: PosterizeLUT,
+    Contrast: ContrastLUT,
+    Brightness: BrightnessLUT,
+    Identity: IdentityLUT,
+}
+
+
+def fuse_lut(img, ops):
+    '''applies ops (op, val) to an L or RGB image, runs of photometric ops are composed into one
+    lookup table per band and applied with a single img.point, other ops flush the table and run as is.
+    '''
+    lut, base = None, None
+    for op, val in ops:
+        lut_op = lut_ops.get(op)
+        if op is Color and img.mode == "L":
+            # the degenerate image of Color is img.convert("L"), a no-op on grayscale
+            lut_op = IdentityLUT
+        if lut_op is None:
+            if lut is not None:
+                img = img.point(lut.ravel().tolist())
+                lut = None
+            img = op(img, val)
+            continue
+        if lut is None:
+            base = np.array(img.histogram(), dtype=np.int64).reshape(-1, 256)
+            lut = np.tile(np.arange(256), (len(base), 1))
+        # histogram of the image as it would be after the pending table
+        hist = np.stack([np.bincount(l, weights=h, minlength=256) for l, h in zip(lut, base)]).astype(np.int64)
+        lut = np.take_along_axis(lut_op(hist, val), lut, 1)
+    if lut is not None:
+        img = img.point(lut.ravel().tolist())
+    return img
+
+
 class Lighting(object):
     """Lighting noise(AlexNet - style PCA - based noise)"""
 
@@ -258,15 +357,19 @@ class CutoutDefault(object):
 
 
 class RandAugment:
-    def __init__(self, n, m):
+    def __init__(self, n, m, fuse_lut=False):
         self.n = n
         self.m = m  # [0, 30]
         self.augment_list = augment_list()
+        # compose consecutive photometric ops into one lookup table pass, L and RGB images only
+        self.fuse_lut = fuse_lut
 
     def __call__(self, img):
         ops = random.choices(self.augment_list, k=self.n)
-        for op, minval, maxval in ops:
-            val = (float(self.m) / 30) * float(maxval - minval) + minval
+        ops = [(op, (float(self.m) / 30) * float(maxval - minval) + minval) for op, minval, maxval in ops]
+        if self.fuse_lut and img.mode in ("L", "RGB"):
+            return fuse_lut(img, ops)
+        for op, val in ops:
             img = op(img, val)
 
         return img
@@ -57,6 +57,13 @@ def vit_transform_randaug(size=800):
     return trs
 
 
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+# single channel stats for grayscale inputs, eva_vit.fold_patch_embed_depth absorbs the per-channel difference
+GRAY_MEAN = (sum(CLIP_MEAN) / 3,)
+GRAY_STD = (sum(CLIP_STD) / 3,)
+
+
 def clip_transform(size):
     return Compose([
         Resize(size, interpolation=Image.BICUBIC),
@@ -77,7 +84,7 @@ def clip_transform_resizedcrop(size):
     ])
 
 
-def clip_transform_randaug(size):
+def clip_transform_randaug(size, fuse_lut=False):
     trs = Compose([
         Resize(size, interpolation=Image.BICUBIC),
         CenterCrop(size),
@@ -86,6 +93,33 @@ def clip_transform_randaug(size):
         Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
     ])
     trs.transforms.insert(0, lambda image: image.convert('RGBA'))
-    trs.transforms.insert(0, RandAugment(2, 9))
+    trs.transforms.insert(0, RandAugment(2, 9, fuse_lut=fuse_lut))
     trs.transforms.insert(0, lambda image: image.convert('RGB'))
     return trs
+
+
+def clip_gray_transform(size):
+    return Compose([
+        Resize(size, interpolation=Image.BICUBIC),
+        CenterCrop(size),
+        lambda image: image.convert("L"),
+        ToTensor(),
+        Normalize(GRAY_MEAN, GRAY_STD),
+    ])
+
+
+def clip_gray_transform_resizedcrop(size):
+    return Compose([
+        RandomResizedCrop(size, scale=(0.9, 1.0), interpolation=Image.BICUBIC),
+        CenterCrop(size),
+        lambda image: image.convert("L"),
+        ToTensor(),
+        Normalize(GRAY_MEAN, GRAY_STD),
+    ])
+
+
+def clip_gray_transform_randaug(size, fuse_lut=False):
+    trs = clip_gray_transform(size)
+    trs.transforms.insert(0, RandAugment(2, 9, fuse_lut=fuse_lut))
+    trs.transforms.insert(0, lambda image: image.convert('L'))
+    return trs
@@ -1,43 +1,104 @@
+import numpy as np
 import torch
 
 
+def char_spans_to_tokens(offsets, chars):
+    # encoding.char_to_token for an array of chars: one searchsorted over the token start offsets,
+    # special and padding tokens (empty offsets) never match. -1 where char_to_token gives None
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    chars = np.asarray(chars, dtype=np.int64)
+    tokens = np.flatnonzero(offsets[:, 1] > offsets[:, 0])
+    if len(tokens) == 0:
+        return np.full(len(chars), -1)
+    candidates = np.searchsorted(offsets[tokens, 0], chars, side="right") - 1
+    found = candidates >= 0
+    candidates = tokens[np.maximum(candidates, 0)]
+    found &= chars < offsets[candidates, 1]
+    return np.where(found, candidates, -1)
+
+
 def record_ent_ref(encoding, txt_ents):
+    num_tokens = len(encoding["input_ids"])
     encoding["txt_label"] = []
     encoding["txt_ents"] = []
-    encoding["ent_ref"] = [False] * len(encoding["input_ids"])
-    for ent in txt_ents:
-        beg_char = ent[0]
-        end_char = ent[1] - 1
-        beg_token = encoding.char_to_token(beg_char)
-        end_token = encoding.char_to_token(end_char)
-        if beg_token is not None and end_token is not None:
-            for pos in range(beg_token + 1, end_token + 1):
-                encoding["ent_ref"][pos] = True
-            encoding["txt_label"].append(ent[2])
-            encoding["txt_ents"].append(ent)
+    encoding["ent_spans"] = []
+    encoding["ent_ref"] = [False] * num_tokens
+    if len(txt_ents) == 0:
+        return encoding
+
+    chars = np.array([[ent[0], ent[1] - 1] for ent in txt_ents], dtype=np.int64)
+    spans = char_spans_to_tokens(encoding["offset_mapping"], chars.reshape(-1)).reshape(-1, 2)
+    found = (spans >= 0).all(1)
+    spans = spans[found]
+
+    # tokens after the first of an entity, marked with a difference array
+    ref = np.zeros(num_tokens + 1, dtype=np.int64)
+    np.add.at(ref, spans[:, 0] + 1, 1)
+    np.add.at(ref, spans[:, 1] + 1, -1)
+    encoding["ent_ref"] = (np.cumsum(ref[:-1]) > 0).tolist()
+    encoding["txt_label"] = [ent[2] for ent, keep in zip(txt_ents, found) if keep]
+    encoding["txt_ents"] = [ent for ent, keep in zip(txt_ents, found) if keep]
+    encoding["ent_spans"] = spans.tolist()
     return encoding
 
 
+def create_pos_matrices(encodings, max_text_len, max_ent_len, mlm_labels=None):
+    # token spans were resolved by record_ent_ref (or stored by the pre-tokenization pass).
+    # all entities of the batch are scattered at once, entities touching a masked token are skipped
+    batch_size = len(encodings)
+    pos_matrices = torch.zeros((batch_size, max_ent_len, max_text_len), dtype=torch.float)
+    ent_ids = torch.full((batch_size, max_ent_len), -100, dtype=torch.long)
+    ent_masks = torch.zeros((batch_size, max_ent_len), dtype=torch.bool)
+
+    counts = [len(encoding["ent_spans"]) for encoding in encodings]
+    if sum(counts) == 0:
+        return pos_matrices, ent_ids, ent_masks
+    rows = torch.repeat_interleave(torch.arange(batch_size), torch.tensor(counts))
+    spans = torch.tensor([span for encoding in encodings for span in encoding["ent_spans"]], dtype=torch.long)
+    labels = torch.tensor([label for encoding in encodings for label in encoding["txt_label"]], dtype=torch.long)
+    beg, end = spans[:, 0], spans[:, 1]
+
+    keep = torch.ones(len(spans), dtype=torch.bool)
+    if mlm_labels is not None:
+        masked = torch.nn.functional.pad((torch.as_tensor(mlm_labels) != -100).long().cumsum(1), (1, 0))
+        keep = (masked[rows, end + 1] - masked[rows, beg]) == 0
+
+    # slot of every kept entity in its row, the first max_ent_len are kept
+    kept = torch.nn.functional.pad(torch.cumsum(keep.long(), 0), (1, 0))
+    row_firsts = torch.nn.functional.pad(torch.tensor(counts).cumsum(0), (1, 0))[:-1]
+    slots = kept[1:] - 1 - kept[row_firsts][rows]
+    keep &= slots < max_ent_len
+
+    rows, slots, beg, end = rows[keep], slots[keep], beg[keep], end[keep]
+    positions = torch.arange(max_text_len)
+    pos_matrices[rows, slots] = ((positions >= beg[:, None]) & (positions <= end[:, None])).float()
+    ent_ids[rows, slots] = labels[keep]
+    ent_masks[rows, slots] = True
+    return pos_matrices, ent_ids, ent_masks
+
+
 def create_pos_matrix(encoding, max_text_len, max_ent_len, mlm_labels=None):
-    txt_ents = encoding["txt_ents"]
-    pos_matrix = torch.zeros((max_ent_len, max_text_len), dtype=torch.float)
-    ent_ids = torch.ones(max_ent_len, dtype=torch.long) * (-100)
-    ent_masks = torch.zeros(max_ent_len, dtype=torch.bool)
-
-    counter = 0
-    for ent_idx, ent in enumerate(txt_ents):
-        beg_char = ent[0]
-        end_char = ent[1] - 1
-        beg_token = encoding.char_to_token(beg_char)
-        end_token = encoding.char_to_token(end_char)
-        if beg_token is not None and end_token is not None:
-            if mlm_labels is not None and (mlm_labels[beg_token:end_token + 1] != -100).sum() != 0:
-                continue
-            for pos in range(beg_token, end_token + 1):
-                pos_matrix[counter][pos] = True
-            ent_ids[counter] = ent[2]
-            ent_masks[counter] = True
-            counter = counter + 1
-            if counter == max_ent_len:
-                break
-    return pos_matrix, ent_ids, ent_masks
+    if mlm_labels is not None:
+        mlm_labels = torch.as_tensor(mlm_labels)[None]
+    pos_matrices, ent_ids, ent_masks = create_pos_matrices([encoding], max_text_len, max_ent_len, mlm_labels)
+    return pos_matrices[0], ent_ids[0], ent_masks[0]
+
+
+def labels_to_csr(label_lists):
+    # multi-hot labels of a batch as CSR: row i holds indices[offsets[i]:offsets[i + 1]]
+    counts = torch.tensor([len(labels) for labels in label_lists], dtype=torch.long)
+    offsets = torch.nn.functional.pad(counts.cumsum(0), (1, 0))
+    indices = torch.from_numpy(np.concatenate([np.asarray(labels, dtype=np.int64) for labels in label_lists]))
+    return offsets, indices
+
+
+def csr_to_dense(offsets, indices, num_labels, dtype=torch.uint8):
+    dense = torch.zeros((len(offsets) - 1, num_labels), dtype=dtype)
+    rows = torch.repeat_interleave(torch.arange(len(offsets) - 1), offsets[1:] - offsets[:-1])
+    dense[rows, indices] = 1
+    return dense
+
+
+def csr_to_packed(offsets, indices, num_labels):
+    # one bit per label, unpack with np.unpackbits(packed, axis=1, count=num_labels)
+    return torch.from_numpy(np.packbits(csr_to_dense(offsets, indices, num_labels, torch.bool).numpy(), axis=1))
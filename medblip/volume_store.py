@@ -0,0 +1,274 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import SimpleITK as sitk
+
+
+def read_datalist(datalist):
+    df_list = []
+    for data in datalist:
+        filename = f'./local_data/{data}.csv'
+        print('load data from', filename)
+        with open(filename) as f:
+            lines = f.readlines()
+            for line in lines:
+                imgpath,report = line.strip('\n').split('\t')
+                df_list.append((imgpath,report))
+    return df_list
+
+
+def read_volume(imgpath):
+    return torch.from_numpy(sitk.GetArrayFromImage(sitk.ReadImage(imgpath)).astype(np.float32))
+
+
+def norm_img(img):
+    return (img - img.min())/(img.max() - img.min())
+
+
+def pad_img(img, size=224):
+    '''resize the longest side to size and zero pad the volume to a size^3 cube.
+    '''
+    x, y, z = img.shape
+    img = img.unsqueeze(0).unsqueeze(0) # BCHWD
+    max_size = max(x, y, z)
+    new_size = (int(size*x/max_size), int(size*y/max_size), int(size*z/max_size))
+    img = F.interpolate(img,size=new_size,mode='trilinear',align_corners=True)
+
+    x,y,z = new_size
+    new_im = torch.zeros((1,1,size,size,size))
+    x_min = int((size - x) / 2)
+    x_max = x_min + x
+    y_min = int((size - y) / 2)
+    y_max = y_min + y
+    z_min = int((size - z) / 2)
+    z_max = z_min + z
+    new_im[:,:,x_min:x_max,y_min:y_max,z_min:z_max] = img
+
+    return new_im
+
+
+def _padded_size(shape, size):
+    max_size = max(shape)
+    return tuple(int(size*s/max_size) for s in shape)
+
+
+def slab_ranges(depth, positions, thickness):
+    '''[start, stop) of a slab of thickness slices centred at every fractional position along depth.'''
+    ranges = []
+    for position in positions:
+        start = min(max(int(round(position * (depth - 1))) - thickness // 2, 0), depth - thickness)
+        ranges.append((start, start + thickness))
+    return ranges
+
+
+def take_slabs(img, positions=(0.4, 0.5, 0.6), thickness=8):
+    '''[size, size, size] volume -> (1, 1, len(positions), size, size), the mean of each slab along the first axis.
+    three slabs make an input for the depth-3 PatchEmbed of eva_vit.
+    '''
+    slabs = [img[start:stop].float().mean(0) for start, stop in slab_ranges(img.shape[0], positions, thickness)]
+    return torch.stack(slabs)[None, None]
+
+
+def pad_img_batch(imgs, out):
+    '''batched pad_img: resize a list of [x, y, z] volumes into out [B, 1, size, size, size].
+    volumes of the same source shape go through one F.interpolate call and are written
+    straight into the centre of out, which is zeroed once instead of allocated per sample.
+    out is a fresh tensor per batch, it is shared with the main process once a DataLoader worker returns it.
+    '''
+    size = out.shape[-1]
+    out.zero_()
+    groups = dict()
+    for i, img in enumerate(imgs):
+        groups.setdefault(tuple(img.shape), []).append(i)
+
+    for shape, indices in groups.items():
+        group = torch.stack([imgs[i] for i in indices]).unsqueeze(1).float()
+        new_size = _padded_size(shape, size)
+        if new_size != shape:
+            group = F.interpolate(group, size=new_size, mode='trilinear', align_corners=True)
+        x, y, z = new_size
+        x_min, y_min, z_min = int((size - x) / 2), int((size - y) / 2), int((size - z) / 2)
+        out[indices, :, x_min:x_min + x, y_min:y_min + y, z_min:z_min + z] = group.to(out.dtype)
+    return out
+
+
+def bbox_index_path(data):
+    return f'./local_data/{data}_bbox.npz'
+
+
+def _foreground_bbox(imgpath):
+    '''shape, [lo, hi) of the voxels above the volume minimum, and (min, max).'''
+    img = sitk.GetArrayFromImage(sitk.ReadImage(imgpath))
+    vmin, vmax = img.min(), img.max()
+    lo, hi = [0, 0, 0], [0, 0, 0]
+    for axis in range(3):
+        occupied = np.flatnonzero((img > vmin).any(axis=tuple(a for a in range(3) if a != axis)))
+        if len(occupied):
+            lo[axis], hi[axis] = occupied[0], occupied[-1] + 1
+    return list(img.shape) + lo + hi, (vmin, vmax)
+
+
+def build_bbox_index(data, num_workers=8):
+    '''foreground bounding box and intensity range of every volume of ./local_data/{data}.csv,
+    read once in a process pool. read_volume_bbox only reads and resamples that box.
+    '''
+    paths = [imgpath for imgpath, report in read_datalist([data])]
+    with Pool(num_workers) as pool:
+        results = pool.map(_foreground_bbox, paths, chunksize=16)
+    bboxes = np.array([bbox for bbox, vrange in results], dtype=np.int64).reshape(-1, 9)
+    vranges = np.array([vrange for bbox, vrange in results], dtype=np.float32).reshape(-1, 2)
+    np.savez(bbox_index_path(data), bbox=bboxes, vrange=vranges)
+    print(f'{data}: {len(paths)} bounding boxes, mean occupancy {np.mean(np.prod(bboxes[:, 6:] - bboxes[:, 3:6], 1) / np.prod(bboxes[:, :3], 1)):.2f}')
+    return bboxes, vranges
+
+
+def load_bbox_index(datalist):
+    bboxes, vranges = [], []
+    for data in datalist:
+        path = bbox_index_path(data)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'{path} not found, build it with build_bbox_index first')
+        index = np.load(path)
+        bboxes.append(index['bbox'])
+        vranges.append(index['vrange'])
+    return np.concatenate(bboxes), np.concatenate(vranges)
+
+
+def read_volume_bbox(imgpath, bbox):
+    '''read the foreground box grown by one background voxel per side (clipped to the volume).'''
+    shape, lo, hi = bbox[:3], bbox[3:6], bbox[6:]
+    lo = np.maximum(lo - 1, 0)
+    hi = np.minimum(hi + 1, shape)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(imgpath)
+    # sitk indexes (x, y, z), the numpy array is (z, y, x)
+    reader.SetExtractIndex([int(i) for i in lo[::-1]])
+    reader.SetExtractSize([int(i) for i in (hi - lo)[::-1]])
+    img = torch.from_numpy(sitk.GetArrayFromImage(reader.Execute()).astype(np.float32))
+    return img, lo, hi
+
+
+def _lerp_axis(img, axis, in_size, out_size, lo, hi):
+    '''align_corners=True linear resampling of the crop [lo, hi) of an axis of length in_size to out_size.
+    only the outputs whose source falls inside the crop are computed, returns them and their first index.
+    '''
+    scale = (in_size - 1) / (out_size - 1) if out_size > 1 else 0
+    src = torch.arange(out_size, dtype=torch.float32) * scale
+    inside = ((src >= lo) & (src <= hi - 1)).nonzero().flatten()
+    if len(inside) == 0:
+        return img.narrow(axis, 0, 0), 0
+    src = src[inside]
+    left = src.floor().long()
+    weight = (src - left).to(img.dtype)
+    # the crop ends on a background voxel (or the volume border, where F.interpolate clamps too)
+    right = torch.clamp(left + 1, max=hi - 1)
+    shape = [1] * img.dim()
+    shape[axis] = -1
+    weight = weight.view(shape)
+    img = img.index_select(axis, left - lo) * (1 - weight) + img.index_select(axis, right - lo) * weight
+    return img, int(inside[0])
+
+
+def pad_img_bbox(img, bbox, vrange, lo, hi, size=224):
+    '''pad_img(norm_img(volume)) computed from the foreground crop returned by read_volume_bbox.
+    everything outside the crop is background, which normalizes and resamples to the zero padding.
+    '''
+    vmin, vmax = vrange
+    img = (img - vmin)/(vmax - vmin)
+    shape = [int(s) for s in bbox[:3]]
+    new_size = _padded_size(shape, size)
+    start = []
+    for axis in range(3):
+        img, first = _lerp_axis(img, axis, shape[axis], new_size[axis], int(lo[axis]), int(hi[axis]))
+        start.append(int((size - new_size[axis]) / 2) + first)
+
+    new_im = torch.zeros((1,1,size,size,size))
+    x, y, z = img.shape
+    new_im[0,0,start[0]:start[0] + x,start[1]:start[1] + y,start[2]:start[2] + z] = img
+    return new_im
+
+
+def volume_store_path(data, size):
+    return f'./local_data/{data}_volumes_{size}.npy'
+
+
+def _convert_range(args):
+    paths, store_path, size, start = args
+    volumes = np.load(store_path, mmap_mode="r+")
+    for i, imgpath in enumerate(paths):
+        img = pad_img(norm_img(read_volume(imgpath)), size)[0, 0].numpy()
+        if volumes.dtype == np.uint8:
+            img = np.rint(img * 255)
+        volumes[start + i] = img.astype(volumes.dtype)
+    volumes.flush()
+    return len(paths)
+
+
+def build_volume_store(data, size=224, dtype=np.float16, num_workers=8, chunk_size=16):
+    '''read, normalize and resize every volume of ./local_data/{data}.csv once, in a process pool,
+    into a [N, size, size, size] memmap. dtype is float16, or uint8 holding round(255 * value).
+    '''
+    paths = [imgpath for imgpath, report in read_datalist([data])]
+    store_path = volume_store_path(data, size)
+    tmp_path = store_path + '.tmp'
+    volumes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(paths), size, size, size))
+    del volumes
+
+    jobs = [(paths[start:start + chunk_size], tmp_path, size, start) for start in range(0, len(paths), chunk_size)]
+    done = 0
+    with Pool(num_workers) as pool:
+        for n in pool.imap_unordered(_convert_range, jobs):
+            done += n
+            print(f'{data}: {done}/{len(paths)} volumes converted')
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class VolumeStore:
+    '''memory-mapped volume stores of several datalists behind one index.'''
+    def __init__(self, datalist, size=224):
+        self.volumes = []
+        for data in datalist:
+            path = volume_store_path(data, size)
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f'{path} not found, build it with build_volume_store first')
+            self.volumes.append(np.load(path, mmap_mode='r'))
+        self.offsets = np.cumsum([0] + [len(volumes) for volumes in self.volumes])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, index):
+        source = int(np.searchsorted(self.offsets, index, side='right') - 1)
+        return self.volumes[source], index - int(self.offsets[source])
+
+    def __getitem__(self, index):
+        '''(1, 1, size, size, size) float16 tensor in [0, 1]'''
+        volumes, index = self.locate(index)
+        img = torch.from_numpy(np.array(volumes[index]))
+        if img.dtype == torch.uint8:
+            img = img.half() / 255
+        return img[None, None]
+
+    def crop(self, index, start, size):
+        '''(1, 1, *size) sub-volume at voxel start, only its voxels are read from the memmap.'''
+        volumes, index = self.locate(index)
+        region = tuple(slice(b, b + s) for b, s in zip(start, size))
+        img = torch.from_numpy(np.array(volumes[(index,) + region]))
+        if img.dtype == torch.uint8:
+            img = img.half() / 255
+        return img[None, None]
+
+    def slabs(self, index, positions=(0.4, 0.5, 0.6), thickness=8):
+        '''take_slabs reading only the slab slices from the memmap.'''
+        volumes, index = self.locate(index)
+        slabs = []
+        for start, stop in slab_ranges(volumes.shape[1], positions, thickness):
+            slab = torch.from_numpy(np.array(volumes[index, start:stop])).float()
+            if volumes.dtype == np.uint8:
+                slab = slab / 255
+            slabs.append(slab.mean(0))
+        return torch.stack(slabs)[None, None]
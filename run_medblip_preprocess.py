@@ -0,0 +1,70 @@
+from medblip.image_store import build_image_store
+from medblip.pretokenize import build_pretokenized
+from medblip.pretraining_mimic_cxr_dataset import MIMICCXRDataset
+from medblip.quarantine import build_quarantine
+from medblip.volume_store import build_bbox_index, build_volume_store
+
+data_dir = '../ARL/data/'
+image_size = 224
+max_text_len = 40
+num_workers = 8
+
+names = [
+    'mimic_cxr_train',
+    'mimic_cxr_val',
+    'mimic_cxr_test',
+]
+
+# 3D datalists under ./local_data/
+volume_datalist = [
+    'ADNI-train',
+    'NACC-train',
+    'OASIS2-train',
+    'ADNI-test',
+    'NACC-test',
+    'OASIS2-test',
+]
+
+# decode + tokenize every row once and list the failing ones, MIMICCXRDataset(quarantine=True) skips them
+build_quarantine_list = True
+# decode + resize every CXR once, MIMICCXRDataset(image_store=True) reads the result
+build_images = True
+# tokenize every caption once, MIMICCXRDataset(pretokenized=True) reads the result
+build_tokens = True
+# read + normalize + resize every NIfTI volume once, ImageTextContrastiveDataset(volume_store=True) reads the result
+build_volumes = False
+# foreground bounding box of every NIfTI volume, ImageTextContrastiveDataset(foreground_bbox=True) reads the result
+build_bboxes = False
+
+if build_quarantine_list:
+    for name in names:
+        print('validate', name)
+        build_quarantine(data_dir, name, max_text_len=max_text_len, num_workers=num_workers)
+
+if build_images:
+    for name in names:
+        print('build image store for', name)
+        build_image_store(data_dir, name, image_size=image_size, num_workers=num_workers)
+
+if build_tokens:
+    for name in names:
+        print('pre-tokenize', name)
+        dataset = MIMICCXRDataset(
+            data_dir=data_dir,
+            transform_keys=["clip"],
+            image_size=image_size,
+            max_text_len=max_text_len,
+            # every sample, so the file serves datasets built with and without quarantine
+            quarantine=False,
+            split=name.split('_')[-1])
+        build_pretokenized(dataset)
+
+if build_volumes:
+    for data in volume_datalist:
+        print('build volume store for', data)
+        build_volume_store(data, num_workers=num_workers)
+
+if build_bboxes:
+    for data in volume_datalist:
+        print('build bounding boxes for', data)
+        build_bbox_index(data, num_workers=num_workers)
@@ -10,8 +10,11 @@ from medblip.modeling_medblip_biomedlm import MedBLIPModel_biomedlm
 from medblip.dataset import ImageTextContrastiveDataset,ZeroShotImageDataset
 from medblip.dataset import ImageTextContrastiveCollator,ZeroShotImageCollator
 from medblip.trainer import Trainer
+from medblip.eva_vit import fold_patch_embed_depth
+from medblip.transforms.transform import CLIP_MEAN, CLIP_STD, GRAY_MEAN, GRAY_STD
 
 from medblip.pretraining_mimic_cxr_dataset import MIMICCXRDataset
+from medblip.mixture_dataset import MixtureDataset, WeightedSourceSampler
 
 # set random seed
 seed = 42
@@ -27,6 +30,16 @@ os.environ['CUDA_VISIBLE_DEVICES']='0'
 # device = "cuda:0" if torch.cuda.is_available() else "cpu"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# True reads images decoded by run_medblip_preprocess.py (build_images), run that first.
+# without JPEG decoding in the workers two of them keep up
+image_store = False
+num_workers = 2 if image_store else 8
+
+# single-channel CXR pipeline: grayscale transforms, a depth-1 patch embedding, and depth-3 checkpoints folded on load
+gray = False
+train_transform_keys = ["clip_gray"] if gray else ["clip"]
+val_transform_keys = ["clip_gray"] if gray else ["clip"]
+
 train_config = {
     'num_epochs': 100,
     'warmup': 0.1,
@@ -59,8 +72,8 @@ train_config = {
 #     # 'MIRIAD-test',
 # ]
 
-# traindata = ImageTextContrastiveDataset(datalist=train_datalist)
-# train_collate_fn = ImageTextContrastiveCollator()
+# traindata = ImageTextContrastiveDataset(datalist=train_datalist, volume_store=False, pad_in_collate=True)
+# train_collate_fn = ImageTextContrastiveCollator(pad_in_collate=True)
 # trainloader = DataLoader(traindata,
 #     batch_size=7,
 #     collate_fn=train_collate_fn,
@@ -70,8 +83,8 @@ train_config = {
 #     drop_last=True
 #     )
 
-# val_data = ZeroShotImageDataset(datalist=val_datalist)
-# val_collate_fn = ZeroShotImageCollator()
+# val_data = ZeroShotImageDataset(datalist=val_datalist, volume_store=False, pad_in_collate=True)
+# val_collate_fn = ZeroShotImageCollator(pad_in_collate=True)
 # valloader = DataLoader(val_data,
 #     batch_size=7,
 #     collate_fn=val_collate_fn,
@@ -80,29 +93,40 @@ train_config = {
 #     num_workers=4,
 #     )
 
+# mix sources by ratio, every source keeps its own table
+# traindata = MixtureDataset([mimic_traindata, other_traindata])
+# trainloader = DataLoader(traindata,
+#     batch_size=8,
+#     sampler=WeightedSourceSampler(traindata, weights=[0.7, 0.3]),
+#     pin_memory=True,
+#     collate_fn=traindata.collate,
+#     num_workers=2)
+
 traindata = MIMICCXRDataset(
     data_dir='../ARL/data/', 
-    transform_keys = ["clip"],
+    transform_keys = train_transform_keys,
     image_size = 224,
+    image_store = image_store,
     split='train')
 trainloader = DataLoader(traindata,
     batch_size=8,
     shuffle=True,
     pin_memory=True,
     collate_fn=traindata.collate,
-    num_workers=8)
+    num_workers=num_workers)
 
 val_data = MIMICCXRDataset(
     data_dir='../ARL/data/', 
-    transform_keys = ["clip"],
+    transform_keys = val_transform_keys,
     image_size = 224,
+    image_store = image_store,
     split='test')
 valloader = DataLoader(val_data,
     batch_size=8,
     shuffle=False,
     pin_memory=True,
     collate_fn=val_data.collate,
-    num_workers=8)
+    num_workers=num_workers)
 
 
 t5=False
@@ -111,6 +135,7 @@ biomedlm=True
 if t5:
     model = MedBLIPModel_t5(
         t5_model="google/flan-t5-xl",
+        vit_in_depth=1 if gray else 3,
     )
     # model.load_state_dict(torch.load('./checkpoints/vision_text_pretrain/t5/epoch10.pth',map_location='cpu'),strict=False)
     model.cuda()
@@ -131,11 +156,16 @@ if t5:
 if biomedlm:
     model = MedBLIPModel_biomedlm(
         lm_model="stanford-crfm/BioMedLM",
+        vit_in_depth=1 if gray else 3,
     )
 
     ##############################################
     start_epoch = 5
-    model.load_state_dict(torch.load(fr'./checkpoints/vision_text_pretrain/biomedlm/epoch{start_epoch}.pth',map_location='cpu'))
+    state_dict = torch.load(fr'./checkpoints/vision_text_pretrain/biomedlm/epoch{start_epoch}.pth',map_location='cpu')
+    if gray:
+        # depth-3 (RGB) patch embedding of the checkpoint folded for the grayscale inputs
+        state_dict = fold_patch_embed_depth(state_dict, CLIP_MEAN, CLIP_STD, GRAY_MEAN[0], GRAY_STD[0])
+    model.load_state_dict(state_dict)
     ##############################################
 
     n_gpus = torch.cuda.device_count()